@@ -0,0 +1,143 @@
+'''
+Batch solve with an automated oracle.
+
+Reads puzzles, one per line, as validator card ids and the true hidden (criterion
+index of each validator) separated by `:`, e.g.
+
+    4 9 11 14 : 1 0 0 2
+
+Every question is answered from the true criterions, and one JSON record per
+puzzle is written to stdout as soon as it is solved. Blank lines and lines
+starting with `#` are skipped, and invalid puzzles (see `puzzles.check_puzzle`)
+get a record of `puzzle` and `error` instead.
+With `--log`, each game is also appended to a file of game logs, which
+`game_log.py replay` reads.
+
+Usage:
+    python batch.py puzzles.txt --lookahead 1
+'''
+import argparse
+import contextlib
+import json
+import sys
+import time
+import tracemalloc
+from typing import IO, Callable, Iterable, Iterator, List, Optional, Tuple
+
+from game_log import game_record
+from puzzles import check_puzzle
+from turing_machine_solver import Solver, add_solver_arguments, play, solver_kwargs
+
+Puzzle = Tuple[List[int], Tuple[int, ...]]
+
+
+def parse_puzzle(line: str) -> Puzzle:
+    '''
+    returns the cards and hidden of a puzzle line, or raises ValueError
+    '''
+    cards, separator, hidden = line.partition(':')
+    try:
+        if not separator:
+            raise ValueError
+        return [int(x) for x in cards.split()], tuple([int(x) for x in hidden.split()])
+    except ValueError:
+        raise ValueError(f'invalid puzzle line: {line}') from None
+
+
+def parse_puzzles(lines: Iterable[str], on_error: Optional[Callable[[str, str], None]] = None) -> Iterator[Puzzle]:
+    '''
+    yields the puzzles of lines; an invalid line raises ValueError, or is passed to on_error(line, error) and skipped
+    '''
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        try:
+            puzzle = parse_puzzle(line)
+        except ValueError as e:
+            if on_error is None:
+                raise
+            on_error(line, str(e))
+            continue
+        yield puzzle
+
+
+def format_puzzle(validator_ids: Iterable[int], hidden: Iterable[int]) -> str:
+    return ' '.join([str(x) for x in validator_ids]) + ' : ' + ' '.join([str(x) for x in hidden])
+
+
+def solve_puzzle(validator_ids: List[int], hidden: Tuple[int, ...], *, trace_memory: bool = True, log: Optional[IO[str]] = None, **kwargs) -> dict:
+    '''
+    solves one puzzle, answering questions from hidden; returns a result record, and writes the game to log if given
+    '''
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    solver = Solver(validator_ids, **kwargs)
+    try:
+        rounds = play(solver, lambda code, v: solver.game.validate(v, code, hidden))
+    finally:
+        solver.close()
+    elapsed = time.perf_counter() - start
+    peak_memory = None
+    if trace_memory:
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    if log is not None:
+        log.write(json.dumps(game_record(solver, hidden=list(hidden))) + '\n')
+    true_code = Solver.check_hidden_possible(hidden, solver.game.validators, True)
+    code = solver.hidden_and_codes[0][1] if solver.solved() else None
+    return {
+        'cards': validator_ids,
+        'hidden': list(hidden),
+        'solved': solver.solved(),
+        'correct': solver.solved() and code == true_code,
+        'code': list(code) if code is not None else None,
+        'rounds': rounds,
+        'questions': len(solver.history),
+        'time': elapsed,
+        'peak_memory': peak_memory,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('puzzles', help='puzzle file, - for stdin')
+    parser.add_argument('--no-trace-memory', action='store_true', help='do not measure peak memory, which slows down solving')
+    parser.add_argument('--log', help='append the log of each game to this file, see game_log.py')
+    add_solver_arguments(parser)
+    parser.set_defaults(log_level='warning')
+    args = parser.parse_args()
+    kwargs = solver_kwargs(args)
+
+    n = solved = rounds = questions = invalid = 0
+    start = time.perf_counter()
+    def skip(puzzle: str, error: str):
+        # an invalid puzzle gets an error record instead of stopping the run
+        global invalid
+        print(json.dumps({ 'puzzle': puzzle, 'error': error }), flush=True)
+        invalid += 1
+
+    check_kwargs = {name: kwargs[name] for name in ['mode', 'filter_unique_answer', 'filter_useless_validators', 'space'] if name in kwargs}
+    with (open(args.puzzles) if args.puzzles != '-' else contextlib.nullcontext(sys.stdin)) as f, (open(args.log, 'a') if args.log else contextlib.nullcontext()) as log:
+        for validator_ids, hidden in parse_puzzles(f, skip):
+            reason = check_puzzle(validator_ids, hidden, **check_kwargs)
+            if reason is not None:
+                skip(format_puzzle(validator_ids, hidden), reason)
+                continue
+            result = solve_puzzle(validator_ids, hidden, trace_memory=not args.no_trace_memory, log=log, **kwargs)
+            print(json.dumps(result), flush=True)
+            n += 1
+            solved += result['correct']
+            rounds += result['rounds']
+            questions += result['questions']
+    elapsed = time.perf_counter() - start
+
+    if n > 0:
+        print(f'{solved}/{n} puzzles solved, {rounds / n:.3f} rounds and {questions / n:.3f} questions on average, {elapsed:.3f}s ({n / elapsed:.1f} puzzles/s)', file=sys.stderr)
+    if invalid > 0:
+        print(f'{invalid} invalid puzzles skipped', file=sys.stderr)
+    if kwargs.get('cache') is not None:
+        print('State cache:', ', '.join([f'{name} {value}' for name, value in kwargs['cache'].stats().items()]), file=sys.stderr)
+        kwargs['cache'].close()
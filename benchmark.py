@@ -0,0 +1,260 @@
+'''
+Benchmarks of solver stages on representative games.
+
+For each game and stage, reports the best wall time of several runs, the number
+of Python function calls (from a separate profiled run) and the peak memory
+(from a separate tracemalloc run). Results can be saved as a JSON baseline and
+compared against a saved baseline to flag regressions of any of them.
+
+With --scaling, the stages that depend on the number of codes are also timed
+on one game in code spaces of more digits and values. --check-parallel checks
+that searches in worker processes find the same top queries as serial ones.
+
+Usage:
+    python benchmark.py --save baseline.json
+    python benchmark.py --compare baseline.json
+    python benchmark.py --games rulebook --scaling
+    python benchmark.py --check-parallel --workers 3
+'''
+import argparse
+import cProfile
+import json
+import os
+import pstats
+import subprocess
+import sys
+import time
+import tracemalloc
+from typing import Callable, Dict, List
+
+from batch import solve_puzzle
+import criterion_table
+import turing_machine_solver
+from criterion_table import CodeSpace, code_space
+from turing_machine_solver import Game, Solver
+
+# name => validator ids
+GAMES = {
+    'rulebook': [4, 9, 11, 14],
+    '4 cards with 33 and 48': [33, 40, 41, 48],
+    '5 cards': [15, 23, 26, 33, 36],
+    '5 cards with 33 and 48': [1, 25, 33, 47, 48],
+    '6 cards with 33 and 48': [10, 22, 33, 40, 41, 48],
+    'extreme 4 validators': [4, 9, 11, 14, 15, 23, 26, 33],
+    'extreme 5 validators with 33 and 48': [1, 25, 33, 47, 48, 4, 9, 11, 14, 15],
+    'extreme 4 validators with 11 and 48': [4, 9, 11, 48, 14, 15, 2, 5],
+    'nightmare rulebook': [4, 9, 11, 14],
+    'nightmare 4 cards': [7, 27, 36, 42],
+}
+# name => mode, for games that are not classic
+MODES = {
+    'extreme 4 validators': 'extreme',
+    'extreme 5 validators with 33 and 48': 'extreme',
+    # cards 11 and 48 share their criterions, so which one validator B checks cannot be told
+    'extreme 4 validators with 11 and 48': 'extreme',
+    'nightmare rulebook': 'nightmare',
+    'nightmare 4 cards': 'nightmare',
+}
+# games whose first round has many queries that split the hiddens the same way for different codes,
+# only checked with --check-parallel
+PARALLEL_GAMES = {
+    '4 cards with equivalent queries': [41, 17, 23, 39],
+}
+# solver options of each search that runs in worker processes
+PARALLEL_SEARCHES = [{}, { 'scoring': 'exact', 'engine': 'codes' }]
+# number of puzzles (hiddens) of each game solved in the full solve stage
+SOLVES = 10
+# code spaces (digits, values) of the scaling benchmark, and its game, played without filters
+# since cards over 3 digits cannot determine a unique code of more digits
+SPACES = [(3, 5), (3, 9), (4, 6), (4, 10), (5, 6)]
+SCALING_GAME = [10, 22, 33, 40, 41, 48]
+
+
+def measure(stage: Callable[[], None], repeat: int) -> Dict[str, float]:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        stage()
+        times.append(time.perf_counter() - start)
+
+    profile = cProfile.Profile()
+    profile.runcall(stage)
+    calls = pstats.Stats(profile).total_calls
+
+    tracemalloc.start()
+    stage()
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return { 'time': min(times), 'calls': calls, 'peak_memory': peak_memory }
+
+
+def benchmark_game(validator_ids: List[int], repeat: int, mode: str = 'classic') -> Dict[str, Dict[str, float]]:
+    game = Game(validator_ids, mode)
+    solver = Solver(validator_ids, mode=mode)
+    exact_solver = Solver(validator_ids, mode=mode, scoring='exact', hidden_and_codes=solver.hidden_and_codes)
+    codes_solver = Solver(validator_ids, mode=mode, scoring='exact', engine='codes', hidden_and_codes=solver.hidden_and_codes)
+    possible, _ = Solver.find_hidden_and_codes(game.card_validators, True, False)
+
+    def validator_init():
+        # validators are shared by games, so build them again
+        turing_machine_solver._validators.clear()
+        Game(validator_ids, mode)
+
+    def hidden_enumeration():
+        hidden_and_codes, _ = Solver.find_hidden_and_codes(game.card_validators, True, False)
+        if mode == 'nightmare':
+            game.assign_cards(hidden_and_codes)
+
+    def cold_start():
+        # a new interpreter, which imports the solver and loads validators from the criterion table cache
+        subprocess.run([sys.executable, '-c', f'from turing_machine_solver import Solver; Solver({validator_ids!r}, mode={mode!r})'], cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+
+    def full_solves():
+        for hidden, _ in solver.hidden_and_codes[:SOLVES]:
+            solve_puzzle(validator_ids, hidden, trace_memory=False, mode=mode)
+
+    stages = {
+        'cold start': cold_start,
+        'validator init': validator_init,
+        'hidden enumeration': hidden_enumeration,
+        'useless filtering': lambda: [Solver.find_useless_validator(game.card_validators, hidden, True) for hidden, _ in possible],
+        'next query': solver.next_query,
+        'next query (exact)': exact_solver.next_query,
+        'next query (codes)': codes_solver.next_query,
+        'full solves': full_solves,
+    }
+    if solver.solved():
+        del stages['next query']
+        del stages['next query (exact)']
+        del stages['next query (codes)']
+    return {name: measure(stage, repeat) for name, stage in stages.items()}
+
+
+def benchmark_space(validator_ids: List[int], space: CodeSpace, repeat: int) -> Dict[str, Dict[str, float]]:
+    solver = Solver(validator_ids, space=space, filter_unique_answer=False, filter_useless_validators=False)
+
+    def criterion_compile():
+        criterion_table._space_tables.pop(space, None)
+        criterion_table.load_space_cards(validator_ids, space)
+
+    def validator_init():
+        turing_machine_solver._validators.clear()
+        Game(validator_ids, space=space)
+
+    stages = {
+        'criterion compile': criterion_compile,
+        'validator init': validator_init,
+        'hidden enumeration': lambda: Solver.find_hidden_and_codes(solver.game.validators, False, False),
+        'next query': solver.next_query,
+    }
+    return {name: measure(stage, repeat) for name, stage in stages.items()}
+
+
+def run_scaling(repeat: int) -> Dict[str, Dict[str, Dict[str, float]]]:
+    results = {}
+    for digits, values in SPACES:
+        space = code_space(digits, values)
+        name = f'scaling {digits} digits 1-{values}'
+        print(f'{name} ({len(space.codes)} codes):', *SCALING_GAME, file=sys.stderr)
+        results[name] = benchmark_space(SCALING_GAME, space, repeat)
+        for stage, result in results[name].items():
+            print(f' - {stage:<20} {result["time"] * 1000:10.3f} ms {result["calls"]:10d} calls {result["peak_memory"] / 1024:10.1f} KiB', file=sys.stderr)
+    return results
+
+
+def run(games: Dict[str, List[int]], repeat: int) -> Dict[str, Dict[str, Dict[str, float]]]:
+    results = {}
+    for name, validator_ids in games.items():
+        print(f'{name}:', *validator_ids, file=sys.stderr)
+        results[name] = benchmark_game(validator_ids, repeat, MODES.get(name, 'classic'))
+        for stage, result in results[name].items():
+            print(f' - {stage:<20} {result["time"] * 1000:10.3f} ms {result["calls"]:10d} calls {result["peak_memory"] / 1024:10.1f} KiB', file=sys.stderr)
+    return results
+
+
+def check_parallel(games: Dict[str, List[int]], workers: int, k: int) -> List[str]:
+    '''
+    returns mismatches between the k best first queries of each game searched serially and with workers
+    '''
+    mismatches = []
+    for name, validator_ids in games.items():
+        for options in PARALLEL_SEARCHES:
+            mode = MODES.get(name, 'classic')
+            serial = Solver(validator_ids, mode=mode, **options)
+            parallel = Solver(validator_ids, mode=mode, workers=workers, hidden_and_codes=serial.hidden_and_codes, **options)
+            try:
+                hidden_set = serial.hidden_set(serial.hidden_and_codes)
+                expected = [(query, round(information, 9)) for query, information in serial.top_queries(hidden_set, k)]
+                found = [(query, round(information, 9)) for query, information in parallel.top_queries(hidden_set, k)]
+            finally:
+                parallel.close()
+            label = ', '.join([f'{option} {value}' for option, value in options.items()]) or 'default search'
+            print(f'{name} ({label}): {"OK" if found == expected else "MISMATCH"}', file=sys.stderr)
+            if found != expected:
+                mismatches.append(f'{name} ({label}): {expected} != {found}')
+    return mismatches
+
+
+def compare(results: dict, baseline: dict, threshold: float, min_time: float, min_calls: int = 100, min_memory: int = 64 << 10) -> List[str]:
+    '''
+    returns regressions: stages whose time, function calls or peak memory grew over threshold times baseline,
+    and by more than min_time, min_calls or min_memory (bytes)
+    '''
+    # field => (minimum change, format of a value)
+    fields = {
+        'time': (min_time, lambda value: f'{value * 1000:.3f} ms'),
+        'calls': (min_calls, lambda value: f'{value} calls'),
+        'peak_memory': (min_memory, lambda value: f'{value / 1024:.1f} KiB'),
+    }
+    regressions = []
+    for name, stages in results.items():
+        for stage, result in stages.items():
+            base = baseline.get(name, {}).get(stage)
+            if base is None:
+                continue
+            for field, (min_change, format_value) in fields.items():
+                if field not in result or field not in base:
+                    continue
+                if result[field] > base[field] * threshold and result[field] - base[field] > min_change:
+                    ratio = f' ({result[field] / base[field]:.2f}x)' if base[field] else ''
+                    regressions.append(f'{name} / {stage}: {format_value(base[field])} => {format_value(result[field])}{ratio}')
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--games', nargs='+', choices=GAMES.keys(), default=list(GAMES.keys()))
+    parser.add_argument('--repeat', type=int, default=3, help='runs per stage, best time is reported')
+    parser.add_argument('--save', help='save results as JSON baseline')
+    parser.add_argument('--compare', help='JSON baseline to compare against')
+    parser.add_argument('--threshold', type=float, default=1.2, help='flag stages whose time, function calls or peak memory grew over this times baseline')
+    parser.add_argument('--min-time', type=float, default=0.001, help='ignore slowdowns smaller than this many seconds')
+    parser.add_argument('--min-calls', type=int, default=100, help='ignore increases of function calls smaller than this')
+    parser.add_argument('--min-memory', type=int, default=64, help='ignore increases of peak memory smaller than this many KiB')
+    parser.add_argument('--scaling', action='store_true', help='also time stages in code spaces of more digits and values')
+    parser.add_argument('--check-parallel', action='store_true', help='only check that searches with --workers find the same top queries as serial ones')
+    parser.add_argument('--workers', type=int, default=3, help='processes of --check-parallel')
+    parser.add_argument('--top', type=int, default=10, help='number of top queries compared by --check-parallel')
+    args = parser.parse_args()
+
+    if args.check_parallel:
+        games = {name: GAMES[name] for name in args.games}
+        games.update(PARALLEL_GAMES)
+        mismatches = check_parallel(games, args.workers, args.top)
+        sys.exit(1 if mismatches else 0)
+
+    results = run({name: GAMES[name] for name in args.games}, args.repeat)
+    if args.scaling:
+        results.update(run_scaling(args.repeat))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold, args.min_time, args.min_calls, args.min_memory << 10)
+        for regression in regressions:
+            print('Regression:', regression, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+        print('No regressions', file=sys.stderr)
@@ -0,0 +1,212 @@
+'''
+Precomputed solution book.
+
+For every set of validator cards the filtered hiddens and the best first query
+are deterministic, so they can be computed offline and looked up at startup.
+
+File layout (little-endian):
+ - header: magic, number of slots, number of entries, filter flags, fingerprint of the criterion table and the solver (see book_fingerprint)
+ - slots: open-addressing hash table of (sorted card ids padded to MAX_CARDS bytes, record offset)
+ - records: number of hiddens, then each hidden's criterion indices and code digits,
+   then number of questions of the best query, its code digits and validators
+
+Usage:
+    python book.py build-book --sizes 4 5 --output book.bin
+    python book.py lookup book.bin 4 9 11 14
+'''
+import argparse
+import hashlib
+import itertools
+import mmap
+import os
+import struct
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, List, Optional, Sequence, Tuple
+
+from constants import VALIDATORS
+from criterion_table import CUSTOM_CARDS, fingerprint
+
+MAGIC = b'TMBOOK1\0'
+MAX_CARDS = 6
+HEADER = struct.Struct('<8sIIB20s')
+SLOT = struct.Struct(f'<{MAX_CARDS}sI')
+EMPTY_KEY = bytes(MAX_CARDS)
+# best queries are picked by the scoring of the solver
+SOLVER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'turing_machine_solver.py')
+
+FILTER_UNIQUE_ANSWER = 1
+FILTER_USELESS_VALIDATORS = 2
+
+HiddenAndCodes = List[Tuple[Tuple[int, ...], Tuple[int, int, int]]]
+Query = List[Tuple[Tuple[int, int, int], int]]
+
+
+def book_fingerprint() -> bytes:
+    '''
+    returns the fingerprint of a book: of the criterion table, and of the solver, which picks the best queries
+    '''
+    digest = hashlib.sha1(fingerprint().encode())
+    with open(SOLVER_PATH, 'rb') as f:
+        digest.update(f.read())
+    return digest.digest()
+
+
+def book_key(validator_ids: Sequence[int]) -> bytes:
+    return bytes(sorted(validator_ids)).ljust(MAX_CARDS, b'\0')
+
+
+def encode_entry(n_validators: int, hidden_and_codes: HiddenAndCodes, query: Query) -> bytes:
+    data = [struct.pack('<I', len(hidden_and_codes))]
+    for hidden, code in hidden_and_codes:
+        data.append(bytes(hidden) + bytes(code))
+    data.append(bytes([len(query)]))
+    if query:
+        data.append(bytes(query[0][0]) + bytes([v for _, v in query]))
+    return b''.join(data)
+
+
+def decode_entry(buffer: bytes, offset: int, n_validators: int) -> Tuple[HiddenAndCodes, Query]:
+    n_hiddens, = struct.unpack_from('<I', buffer, offset)
+    offset += 4
+    hidden_and_codes = []
+    for _ in range(n_hiddens):
+        hidden = tuple(buffer[offset:offset + n_validators])
+        code = tuple(buffer[offset + n_validators:offset + n_validators + 3])
+        hidden_and_codes.append((hidden, code))
+        offset += n_validators + 3
+    n_questions = buffer[offset]
+    offset += 1
+    query = []
+    if n_questions:
+        code = tuple(buffer[offset:offset + 3])
+        query = [(code, v) for v in buffer[offset + 3:offset + 3 + n_questions]]
+    return hidden_and_codes, query
+
+
+class Book:
+    def __init__(self, path: str) -> None:
+        self.path = path
+        with open(path, 'rb') as f:
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.n_slots, self.n_entries, flags, self.fingerprint = HEADER.unpack_from(self.buffer, 0)
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not a solution book')
+        self.filter_unique_answer = bool(flags & FILTER_UNIQUE_ANSWER)
+        self.filter_useless_validators = bool(flags & FILTER_USELESS_VALIDATORS)
+        self.records_offset = HEADER.size + self.n_slots * SLOT.size
+
+    def up_to_date(self) -> bool:
+        return self.fingerprint == book_fingerprint()
+
+    def lookup(self, validator_ids: Sequence[int]) -> Optional[Tuple[HiddenAndCodes, Query]]:
+        '''
+        returns filtered hiddens and best first query for sorted validator_ids, or None if not in book
+        '''
+        if len(validator_ids) > MAX_CARDS or len(set(validator_ids)) != len(validator_ids):
+            return None
+        # books only hold built-in cards, whose ids fit in a byte
+        if any([not 1 <= validator_id <= 255 or validator_id not in VALIDATORS or validator_id in CUSTOM_CARDS for validator_id in validator_ids]):
+            return None
+        key = book_key(validator_ids)
+        slot = zlib.crc32(key) % self.n_slots
+        while True:
+            slot_key, offset = SLOT.unpack_from(self.buffer, HEADER.size + slot * SLOT.size)
+            if slot_key == EMPTY_KEY:
+                return None
+            if slot_key == key:
+                return decode_entry(self.buffer, self.records_offset + offset, len(validator_ids))
+            slot = (slot + 1) % self.n_slots
+
+    def close(self):
+        self.buffer.close()
+
+
+def write_book(path: str, entries: Iterable[Tuple[Sequence[int], bytes]], *, filter_unique_answer: bool = True, filter_useless_validators: bool = True) -> int:
+    '''
+    writes (validator_ids, encoded entry) pairs to a book, returns number of entries
+    '''
+    records_path = path + '.records'
+    keys = []
+    offsets = []
+    offset = 0
+    with open(records_path, 'wb') as records:
+        for validator_ids, record in entries:
+            keys.append(book_key(validator_ids))
+            offsets.append(offset)
+            records.write(record)
+            offset += len(record)
+
+    n_slots = 1
+    while n_slots < 2 * len(keys):
+        n_slots *= 2
+    slots = bytearray(n_slots * SLOT.size)
+    for key, offset in zip(keys, offsets):
+        slot = zlib.crc32(key) % n_slots
+        while slots[slot * SLOT.size:slot * SLOT.size + MAX_CARDS] != EMPTY_KEY:
+            slot = (slot + 1) % n_slots
+        SLOT.pack_into(slots, slot * SLOT.size, key, offset)
+
+    flags = (FILTER_UNIQUE_ANSWER if filter_unique_answer else 0) | (FILTER_USELESS_VALIDATORS if filter_useless_validators else 0)
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, n_slots, len(keys), flags, book_fingerprint()))
+        f.write(slots)
+        with open(records_path, 'rb') as records:
+            while True:
+                chunk = records.read(1 << 20)
+                if not chunk:
+                    break
+                f.write(chunk)
+    os.remove(records_path)
+    return len(keys)
+
+
+def solve_entry(validator_ids: Tuple[int, ...]) -> Tuple[Tuple[int, ...], bytes]:
+    from turing_machine_solver import Solver
+    solver = Solver(validator_ids)
+    query = solver.next_query() if len(solver.hidden_and_codes) > 1 else []
+    return validator_ids, encode_entry(len(validator_ids), solver.hidden_and_codes, query)
+
+
+def build_book(path: str, card_ids: Sequence[int], sizes: Sequence[int], workers: int = 1, batch_size: int = 4096) -> int:
+    combinations = itertools.chain(*[itertools.combinations(sorted(card_ids), size) for size in sizes])
+    if workers <= 1:
+        return write_book(path, map(solve_entry, combinations))
+    from turing_machine_solver import map_in_batches
+    with ProcessPoolExecutor(workers) as executor:
+        return write_book(path, map_in_batches(executor, solve_entry, combinations, batch_size, chunksize=64))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build_parser = subparsers.add_parser('build-book', help='solve every combination of cards and write a book')
+    build_parser.add_argument('--sizes', nargs='+', type=int, default=[4, 5, 6], choices=range(1, MAX_CARDS + 1))
+    build_parser.add_argument('--cards', nargs='+', type=int, default=sorted(VALIDATORS.keys()), help='cards to combine')
+    build_parser.add_argument('--output', default='book.bin')
+    build_parser.add_argument('--workers', type=int, default=os.cpu_count())
+    lookup_parser = subparsers.add_parser('lookup', help='print the book entry of a game')
+    lookup_parser.add_argument('book')
+    lookup_parser.add_argument('validator_ids', nargs='+', type=int)
+    args = parser.parse_args()
+
+    if args.command == 'build-book':
+        n = build_book(args.output, args.cards, args.sizes, args.workers)
+        print(f'{n} games written to {args.output}')
+    else:
+        book = Book(args.book)
+        if not book.up_to_date():
+            print('Warning: book was built from a different constants.py')
+        entry = book.lookup(args.validator_ids)
+        if entry is None:
+            print('Not in book:', sorted(args.validator_ids))
+        else:
+            hidden_and_codes, query = entry
+            print('Game:', sorted(args.validator_ids))
+            print('Filtered hiddens and corresponding codes:')
+            for hidden, code in hidden_and_codes:
+                print(' -', hidden, '=>', code)
+            print(f'({len(hidden_and_codes)} possible hiddens in total)')
+            if query:
+                print('[Query]', query[0][0], *[chr(v + ord('A')) for _, v in query])
+        book.close()
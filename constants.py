@@ -284,6 +284,290 @@ VALIDATORS = {
     ],
 }
 
+# criterions of VALIDATORS in the language of criterion_dsl.py
+CRITERIONS = {
+    1: [
+        't == 1',
+        't > 1',
+    ],
+    2: [
+        't < 3',
+        't == 3',
+        't > 3',
+    ],
+    3: [
+        's < 3',
+        's == 3',
+        's > 3',
+    ],
+    4: [
+        's < 4',
+        's == 4',
+        's > 4',
+    ],
+    5: [
+        'even(t)',
+        'odd(t)',
+    ],
+    6: [
+        'even(s)',
+        'odd(s)',
+    ],
+    7: [
+        'even(c)',
+        'odd(c)',
+    ],
+    8: [
+        'count(1) == 0',
+        'count(1) == 1',
+        'count(1) == 2',
+        'count(1) == 3',
+    ],
+    9: [
+        'count(3) == 0',
+        'count(3) == 1',
+        'count(3) == 2',
+        'count(3) == 3',
+    ],
+    10: [
+        'count(4) == 0',
+        'count(4) == 1',
+        'count(4) == 2',
+        'count(4) == 3',
+    ],
+    11: [
+        't < s',
+        't == s',
+        't > s',
+    ],
+    12: [
+        't < c',
+        't == c',
+        't > c',
+    ],
+    13: [
+        's < c',
+        's == c',
+        's > c',
+    ],
+    14: [
+        't < s and t < c',
+        's < t and s < c',
+        'c < t and c < s',
+    ],
+    15: [
+        't > s and t > c',
+        's > t and s > c',
+        'c > t and c > s',
+    ],
+    16: [
+        'evens() >= 2',
+        'evens() < 2',
+    ],
+    17: [
+        'evens() == 0',
+        'evens() == 1',
+        'evens() == 2',
+        'evens() == 3',
+    ],
+    18: [
+        'sum() % 2 == 0',
+        'sum() % 2 != 0',
+    ],
+    19: [
+        't + s < 6',
+        't + s == 6',
+        't + s > 6',
+    ],
+    20: [
+        't == s == c',
+        't == s != c or t == c != s or s == c != t',
+        't != s and t != c and s != c',
+    ],
+    21: [
+        't != s and t != c and s != c',
+        't == s or t == c or s == c',
+    ],
+    22: [
+        'ascending()',
+        'descending()',
+        'not ascending() and not descending()',
+    ],
+    23: [
+        'sum() < 6',
+        'sum() == 6',
+        'sum() > 6',
+    ],
+    24: [
+        't + 1 == s == c - 1',
+        't + 1 == s != c - 1 or t + 1 != s == c - 1',
+        't + 1 != s != c - 1',
+    ],
+    25: [
+        't + 1 != s != t - 1 and s + 1 != c != s - 1',
+        't + 1 == s != c - 1 or t - 1 == s != c + 1 or t + 1 != s == c - 1 or t - 1 != s == c + 1',
+        't + 1 == s == c - 1 or t - 1 == s == c + 1',
+    ],
+    26: [
+        't < 3',
+        's < 3',
+        'c < 3',
+    ],
+    27: [
+        't < 4',
+        's < 4',
+        'c < 4',
+    ],
+    28: [
+        't == 1',
+        's == 1',
+        'c == 1',
+    ],
+    29: [
+        't == 3',
+        's == 3',
+        'c == 3',
+    ],
+    30: [
+        't == 4',
+        's == 4',
+        'c == 4',
+    ],
+    31: [
+        't > 1',
+        's > 1',
+        'c > 1',
+    ],
+    32: [
+        't > 3',
+        's > 3',
+        'c > 3',
+    ],
+    33: [
+        'even(t)',
+        'even(s)',
+        'even(c)',
+        'odd(t)',
+        'odd(s)',
+        'odd(c)',
+    ],
+    34: [
+        's >= t <= c',
+        't >= s <= c',
+        't >= c <= s',
+    ],
+    35: [
+        's <= t >= c',
+        't <= s >= c',
+        't <= c >= s',
+    ],
+    36: [
+        'sum() % 3 == 0',
+        'sum() % 4 == 0',
+        'sum() % 5 == 0',
+    ],
+    37: [
+        't + s == 4',
+        't + c == 4',
+        's + c == 4',
+    ],
+    38: [
+        't + s == 6',
+        't + c == 6',
+        's + c == 6',
+    ],
+    39: [
+        't == 1',
+        's == 1',
+        'c == 1',
+        't > 1',
+        's > 1',
+        'c > 1',
+    ],
+    40: [
+        't < 3',
+        's < 3',
+        'c < 3',
+        't == 3',
+        's == 3',
+        'c == 3',
+        't > 3',
+        's > 3',
+        'c > 3',
+    ],
+    41: [
+        't < 4',
+        's < 4',
+        'c < 4',
+        't == 4',
+        's == 4',
+        'c == 4',
+        't > 4',
+        's > 4',
+        'c > 4',
+    ],
+    42: [
+        's > t < c',
+        't > s < c',
+        't > c < s',
+        's < t > c',
+        't < s > c',
+        't < c > s',
+    ],
+    43: [
+        't < s',
+        't == s',
+        't > s',
+        't < c',
+        't == c',
+        't > c',
+    ],
+    44: [
+        's < t',
+        's == t',
+        's > t',
+        's < c',
+        's == c',
+        's > c',
+    ],
+    45: [
+        'count(1) == 0',
+        'count(1) == 1',
+        'count(1) == 2',
+        'count(3) == 0',
+        'count(3) == 1',
+        'count(3) == 2',
+    ],
+    46: [
+        'count(3) == 0',
+        'count(3) == 1',
+        'count(3) == 2',
+        'count(4) == 0',
+        'count(4) == 1',
+        'count(4) == 2',
+    ],
+    47: [
+        'count(1) == 0',
+        'count(1) == 1',
+        'count(1) == 2',
+        'count(4) == 0',
+        'count(4) == 1',
+        'count(4) == 2',
+    ],
+    48: [
+        't < s',
+        't < c',
+        's < c',
+        't == s',
+        't == c',
+        's == c',
+        't > s',
+        't > c',
+        's > c',
+    ],
+}
+
+
 from typing import Callable, Container
 import itertools
 def is_mutually_exclusive(standards: Container[Callable[[int, int, int], bool]]):
@@ -295,5 +579,4 @@ def is_mutually_exclusive(standards: Container[Callable[[int, int, int], bool]])
 
 MUTUALLY_EXCLUSIVE_VALIDATORS = [
     1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17, 18, 19, 20, 21, 22, 23, 24, 25
-]
-assert(all([is_mutually_exclusive(VALIDATORS[validator_id]) for validator_id in MUTUALLY_EXCLUSIVE_VALIDATORS]))
\ No newline at end of file
+]
\ No newline at end of file
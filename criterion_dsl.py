@@ -0,0 +1,285 @@
+'''
+Declarative criterions.
+
+A criterion is a Python-like expression over the digits `t`, `s` and `c` of a
+code, e.g. `t + s < 6`, `count(1) == 2` or `t < s > c`. Unlike lambdas,
+criterions can be inspected, pickled and compiled over all codes at once, into
+a bitmask (see criterion_table.py) or a NumPy evaluator, for codes of any
+number of digits and values (see criterion_table.CodeSpace), where further
+digits are `p` and `h`.
+
+The language has:
+ - integer constants and the digits `t`, `s`, `c`, ...
+ - arithmetic `+`, `-`, `*`, `%` and unary `-`
+ - comparisons `==`, `!=`, `<`, `<=`, `>`, `>=`, which can be chained as `t < s < c`
+ - `and`, `or`, `not`, on comparisons only
+ - counts: `count(n)` digits equal to n, `evens()` and `odds()` even and odd digits
+ - parity: `even(x)`, `odd(x)`
+ - sums: `sum()` is the sum of all digits, `t + s + c` for 3 digits
+ - ordering: `ascending()` is `t < s < c` for 3 digits, `descending()` is `t > s > c`
+
+A comparison counts as 1 or 0 in arithmetic, e.g. `(t == 4) + (s == 4) == 1`.
+The calls are rewritten into the expressions above before compiling.
+
+Cards beyond the ones in constants.py can be added with `add_card`, or from a
+JSON file of `{ "card number": ["criterion", ...] }` with `load_cards`.
+'''
+import ast
+import json
+import operator
+from typing import Callable, Dict, List, Sequence, Tuple, Union
+
+from constants import CRITERIONS, VALIDATORS
+from criterion_table import CUSTOM_CARDS, DEFAULT_SPACE, CodeSpace, add_compiled_card
+
+BINARY_OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Mod: operator.mod,
+}
+COMPARE_OPERATORS = {
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+    ast.Lt: operator.lt,
+    ast.LtE: operator.le,
+    ast.Gt: operator.gt,
+    ast.GtE: operator.ge,
+}
+
+# name => (number of arguments, expression of digit names with the argument as x)
+FUNCTIONS: Dict[str, Tuple[int, Callable[[List[str]], str]]] = {
+    'count': (1, lambda names: ' + '.join([f'({name} == x)' for name in names])),
+    'evens': (0, lambda names: ' + '.join([f'({name} % 2 == 0)' for name in names])),
+    'odds': (0, lambda names: ' + '.join([f'({name} % 2 != 0)' for name in names])),
+    'even': (1, lambda names: 'x % 2 == 0'),
+    'odd': (1, lambda names: 'x % 2 != 0'),
+    'sum': (0, lambda names: ' + '.join(names)),
+    'ascending': (0, lambda names: ' < '.join(names)),
+    'descending': (0, lambda names: ' > '.join(names)),
+}
+
+
+class CriterionError(ValueError):
+    pass
+
+
+class _Expander(ast.NodeTransformer):
+    '''
+    rewrites calls of FUNCTIONS into core expressions over digit names
+    '''
+    def __init__(self, names: List[str]):
+        self.names = names
+
+    def visit_Call(self, node: ast.Call) -> ast.AST:
+        self.generic_visit(node)
+        if not isinstance(node.func, ast.Name) or node.func.id not in FUNCTIONS:
+            raise CriterionError(f'unknown function: {ast.unparse(node.func)}')
+        n_args, body = FUNCTIONS[node.func.id]
+        if node.keywords or len(node.args) != n_args:
+            raise CriterionError(f'{node.func.id}() takes {n_args} argument(s)')
+        expanded = ast.parse(body(self.names), mode='eval').body
+        if n_args == 0:
+            return expanded
+        return _Substitute(node.args[0]).visit(expanded)
+
+
+class _Substitute(ast.NodeTransformer):
+    def __init__(self, argument: ast.AST):
+        self.argument = argument
+
+    def visit_Name(self, node: ast.Name) -> ast.AST:
+        return self.argument if node.id == 'x' else node
+
+
+def _check(node: ast.AST, names: List[str]) -> str:
+    '''
+    returns the type of a core expression, 'int' or 'bool', or raises CriterionError
+    '''
+    if isinstance(node, ast.Name):
+        if node.id not in names:
+            raise CriterionError(f'unknown name: {node.id}')
+        return 'int'
+    if isinstance(node, ast.Constant):
+        if type(node.value) is not int:
+            raise CriterionError(f'not an integer: {node.value!r}')
+        return 'int'
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+        _check(node.operand, names)
+        return 'int'
+    if isinstance(node, ast.BinOp) and type(node.op) in BINARY_OPERATORS:
+        _check(node.left, names)
+        _check(node.right, names)
+        return 'int'
+    if isinstance(node, ast.Compare) and all([type(op) in COMPARE_OPERATORS for op in node.ops]):
+        for operand in [node.left, *node.comparators]:
+            _check(operand, names)
+        return 'bool'
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not) or isinstance(node, ast.BoolOp):
+        for operand in [node.operand] if isinstance(node, ast.UnaryOp) else node.values:
+            if _check(operand, names) != 'bool':
+                raise CriterionError(f'not a comparison: {ast.unparse(operand)}')
+        return 'bool'
+    raise CriterionError(f'unsupported expression: {ast.unparse(node)}')
+
+
+def parse(source: str, space: CodeSpace = DEFAULT_SPACE) -> ast.AST:
+    '''
+    returns the core expression of criterion source over the digits of space, or raises CriterionError
+    '''
+    try:
+        tree = ast.parse(source.strip(), mode='eval')
+    except SyntaxError as e:
+        raise CriterionError(f'invalid criterion {source!r}: {e.msg}') from None
+    try:
+        node = _Expander(space.names).visit(tree).body
+        if _check(node, space.names) != 'bool':
+            raise CriterionError('not a comparison')
+    except CriterionError as e:
+        raise CriterionError(f'invalid criterion {source!r}: {e}') from None
+    return node
+
+
+# A value over all codes is a mask of codes for a comparison, or
+# { integer: mask of codes where the expression is that integer } otherwise.
+Values = Union[int, Dict[int, int]]
+
+
+def _integers(values: Values, space: CodeSpace) -> Dict[int, int]:
+    if isinstance(values, int):
+        return {1: values, 0: space.all_codes_mask & ~values}
+    return values
+
+
+def _combine(op: Callable[[int, int], int], left: Dict[int, int], right: Dict[int, int]) -> Dict[int, int]:
+    result = {}
+    for a, a_mask in left.items():
+        for b, b_mask in right.items():
+            mask = a_mask & b_mask
+            if mask:
+                try:
+                    value = op(a, b)
+                except ZeroDivisionError:
+                    raise CriterionError('modulo by zero') from None
+                result[value] = result.get(value, 0) | mask
+    return result
+
+
+def _compare(op: Callable[[int, int], bool], left: Dict[int, int], right: Dict[int, int]) -> int:
+    mask = 0
+    for a, a_mask in left.items():
+        for b, b_mask in right.items():
+            if op(a, b):
+                mask |= a_mask & b_mask
+    return mask
+
+
+def _masks(node: ast.AST, space: CodeSpace) -> Values:
+    if isinstance(node, ast.Name):
+        i = space.names.index(node.id)
+        return {value: space.digit_mask(i, value) for value in range(1, space.values + 1)}
+    if isinstance(node, ast.Constant):
+        return {node.value: space.all_codes_mask}
+    if isinstance(node, ast.UnaryOp):
+        if isinstance(node.op, ast.Not):
+            return space.all_codes_mask & ~_masks(node.operand, space)
+        return {-value: mask for value, mask in _integers(_masks(node.operand, space), space).items()}
+    if isinstance(node, ast.BinOp):
+        return _combine(BINARY_OPERATORS[type(node.op)], _integers(_masks(node.left, space), space), _integers(_masks(node.right, space), space))
+    if isinstance(node, ast.BoolOp):
+        masks = [_masks(value, space) for value in node.values]
+        result = masks[0]
+        for mask in masks[1:]:
+            result = result & mask if isinstance(node.op, ast.And) else result | mask
+        return result
+    # compare
+    operands = [_integers(_masks(operand, space), space) for operand in [node.left, *node.comparators]]
+    mask = space.all_codes_mask
+    for op, left, right in zip(node.ops, operands, operands[1:]):
+        mask &= _compare(COMPARE_OPERATORS[type(op)], left, right)
+    return mask
+
+
+def compile_mask(source: str, space: CodeSpace = DEFAULT_SPACE) -> int:
+    '''
+    returns mask of codes satisfying criterion source: bit `i` is set iff `space.codes[i]` does
+    '''
+    return _masks(parse(source, space), space)
+
+
+def compile_numpy(source: str, space: CodeSpace = DEFAULT_SPACE) -> Callable[..., 'np.ndarray']:
+    '''
+    returns a function of arrays of the digits of space, e.g. t, s, c, that returns a boolean array,
+    True where the code satisfies criterion source
+    '''
+    import numpy as np
+
+    node = parse(source, space)
+
+    def evaluate(node: ast.AST, digits: Dict[str, 'np.ndarray']) -> 'np.ndarray':
+        if isinstance(node, ast.Name):
+            return digits[node.id]
+        if isinstance(node, ast.Constant):
+            return np.int64(node.value)
+        if isinstance(node, ast.UnaryOp):
+            operand = evaluate(node.operand, digits)
+            return ~operand if isinstance(node.op, ast.Not) else -operand.astype(np.int64)
+        if isinstance(node, ast.BinOp):
+            left = evaluate(node.left, digits).astype(np.int64)
+            right = evaluate(node.right, digits).astype(np.int64)
+            return BINARY_OPERATORS[type(node.op)](left, right)
+        if isinstance(node, ast.BoolOp):
+            values = [evaluate(value, digits) for value in node.values]
+            result = values[0]
+            for value in values[1:]:
+                result = result & value if isinstance(node.op, ast.And) else result | value
+            return result
+        operands = [evaluate(operand, digits).astype(np.int64) for operand in [node.left, *node.comparators]]
+        result = True
+        for op, left, right in zip(node.ops, operands, operands[1:]):
+            result = result & COMPARE_OPERATORS[type(op)](left, right)
+        return result
+
+    def evaluator(*digits: 'np.ndarray') -> 'np.ndarray':
+        digits = np.broadcast_arrays(*[np.asarray(digit, dtype=np.int64) for digit in digits])
+        return np.broadcast_to(evaluate(node, dict(zip(space.names, digits))), digits[0].shape)
+
+    return evaluator
+
+
+def compile_function(source: str, space: CodeSpace = DEFAULT_SPACE) -> Callable[..., bool]:
+    '''
+    returns criterion source as a function of the digits of a code, like the lambdas of constants.VALIDATORS
+    '''
+    mask = compile_mask(source, space)
+    return lambda *code: bool(mask >> space.code_indices[code] & 1)
+
+
+def add_card(validator_id: int, criterions: Sequence[str], space: CodeSpace = DEFAULT_SPACE):
+    '''
+    adds a validator card with criterions, which can then be used in games like the cards of constants.py;
+    criterions are checked in space, and compiled in other spaces when games use them
+    '''
+    criterions = list(criterions)
+    if CUSTOM_CARDS.get(validator_id) == criterions:
+        return
+    if validator_id in VALIDATORS:
+        raise CriterionError(f'card {validator_id} already exists')
+    if len(criterions) < 2:
+        raise CriterionError(f'card {validator_id} has less than two criterions')
+    VALIDATORS[validator_id] = [compile_function(criterion, space) for criterion in criterions]
+    CRITERIONS[validator_id] = criterions
+    if space is DEFAULT_SPACE:
+        add_compiled_card(validator_id, criterions, [compile_mask(criterion) for criterion in criterions])
+    else:
+        CUSTOM_CARDS[validator_id] = criterions
+
+
+def load_cards(path: str, space: CodeSpace = DEFAULT_SPACE):
+    '''
+    adds the cards of a JSON file: { "card number": ["criterion", ...] }
+    '''
+    with open(path) as f:
+        cards = json.load(f)
+    for validator_id, criterions in cards.items():
+        add_card(int(validator_id), criterions, space)
@@ -0,0 +1,329 @@
+'''
+Compiled criterion table.
+
+Each criterion of each validator card is compiled once over all codes into a
+bitmask: bit `i` is set iff `CODES[i]` satisfies the criterion, along with the
+number of codes that satisfy it. Criterions are compiled from their expressions
+in `constants.CRITERIONS` (see criterion_dsl.py). Cards are compiled on demand,
+only when a game uses them, and cached to disk next to `constants.py`; the
+cache is discarded whenever `constants.py`, `criterion_dsl.py` or this file
+changes.
+
+Codes are 3 digits from 1 to 5 by default. Variants with other numbers of
+digits or values have their own `CodeSpace`, whose cards are compiled from
+their expressions and kept in memory only.
+
+Usage:
+    python criterion_table.py build     # compile all cards into the cache
+    python criterion_table.py verify    # check constants.py and the cache
+'''
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import sys
+import tempfile
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import constants
+from constants import CRITERIONS, MUTUALLY_EXCLUSIVE_VALIDATORS, NUMBERS, VALIDATORS, is_mutually_exclusive
+
+# names of the digits of a code in criterion expressions: triangle, square, circle, then more shapes for variants
+DIGIT_NAMES = ['t', 's', 'c', 'p', 'h']
+
+
+class CodeSpace:
+    '''
+    all codes of a number of digits, each from 1 to values, in the same order as itertools.product
+    '''
+    def __init__(self, digits: int, values: int) -> None:
+        if not 1 <= digits <= len(DIGIT_NAMES):
+            raise ValueError(f'Number of digits must be from 1 to {len(DIGIT_NAMES)}')
+        if values < 2:
+            raise ValueError('Digits need at least 2 values')
+        self.digits = digits
+        self.values = values
+        self.names = DIGIT_NAMES[:digits]
+        self.codes: List[Tuple[int, ...]] = list(itertools.product(range(1, values + 1), repeat=digits))
+        self.code_indices: Dict[Tuple[int, ...], int] = {code: i for i, code in enumerate(self.codes)}
+        self.all_codes_mask = (1 << len(self.codes)) - 1
+        self.digit_masks: Dict[Tuple[int, int], int] = {}
+
+    def __repr__(self) -> str:
+        return f'CodeSpace({self.digits}, {self.values})'
+
+    def digit_mask(self, i: int, value: int) -> int:
+        '''
+        returns mask of codes whose i-th digit is value
+        '''
+        key = (i, value)
+        mask = self.digit_masks.get(key)
+        if mask is None:
+            if not 1 <= value <= self.values:
+                return 0
+            # codes repeat every period, in which i-th digit is value for one block
+            block = self.values ** (self.digits - 1 - i)
+            period = block * self.values
+            pattern = ((1 << block) - 1) << block * (value - 1)
+            mask = pattern * (((1 << len(self.codes)) - 1) // ((1 << period) - 1))
+            self.digit_masks[key] = mask
+        return mask
+
+
+_spaces: Dict[Tuple[int, int], CodeSpace] = {}
+
+def code_space(digits: int = 3, values: int = len(NUMBERS)) -> CodeSpace:
+    '''
+    returns the code space of digits and values, which is built once and shared
+    '''
+    space = _spaces.get((digits, values))
+    if space is None:
+        space = CodeSpace(digits, values)
+        _spaces[(digits, values)] = space
+    return space
+
+
+DEFAULT_SPACE = code_space()
+CODES: List[Tuple[int, int, int]] = DEFAULT_SPACE.codes
+CODE_INDICES: Dict[Tuple[int, int, int], int] = DEFAULT_SPACE.code_indices
+ALL_CODES_MASK = DEFAULT_SPACE.all_codes_mask
+assert CODES == list(itertools.product(NUMBERS, NUMBERS, NUMBERS))
+
+CONSTANTS_PATH = os.path.abspath(constants.__file__)
+DSL_PATH = os.path.join(os.path.dirname(CONSTANTS_PATH), 'criterion_dsl.py')
+# masks also depend on the code spaces of this file
+TABLE_PATH = os.path.abspath(__file__)
+CACHE_PATH = os.path.join(os.path.dirname(CONSTANTS_PATH), 'criterion_table.json')
+
+if hasattr(int, 'bit_count'):
+    popcount: Callable[[int], int] = int.bit_count
+else:
+    def popcount(mask: int) -> int:
+        return bin(mask).count('1')
+
+
+def lowest_bit(mask: int) -> int:
+    '''
+    returns index of the lowest set bit, or -1 if mask is empty
+    '''
+    return (mask & -mask).bit_length() - 1
+
+
+def iter_bits(mask: int) -> Iterator[int]:
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+def compile_criterion(criterion: Callable[[int, int, int], bool]) -> int:
+    mask = 0
+    for i, code in enumerate(CODES):
+        if criterion(*code):
+            mask |= 1 << i
+    return mask
+
+
+def compile_validators() -> Dict[int, List[int]]:
+    return {validator_id: [compile_criterion(criterion) for criterion in criterions] for validator_id, criterions in VALIDATORS.items()}
+
+
+def compile_card(validator_id: int) -> List[int]:
+    '''
+    returns criterion masks of a card, from its expressions if it has some
+    '''
+    if validator_id not in CRITERIONS:
+        return [compile_criterion(criterion) for criterion in VALIDATORS[validator_id]]
+    # imported on demand, since it is only needed when the disk cache is out of date
+    from criterion_dsl import compile_mask
+    return [compile_mask(criterion) for criterion in CRITERIONS[validator_id]]
+
+
+def fingerprint() -> str:
+    digest = hashlib.sha1()
+    for path in [CONSTANTS_PATH, DSL_PATH, TABLE_PATH]:
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def read_cache(path: str = CACHE_PATH) -> Dict[int, Tuple[List[int], List[int]]]:
+    '''
+    returns { validator_id: ([criterion mask, ...], [number of codes, ...]) } of the cards in
+    the disk cache, or an empty dict if it is missing or was built from another constants.py
+    '''
+    try:
+        with open(path) as f:
+            data = json.load(f)
+        if data['fingerprint'] != fingerprint():
+            return {}
+        return {int(validator_id): ([int(mask, 16) for mask in card['masks']], card['results']) for validator_id, card in data['cards'].items()}
+    except (OSError, ValueError, KeyError, TypeError):
+        return {}
+
+
+def replace_file(path: str, text: str):
+    '''
+    replaces the file at path with text at once: it is written to a file of this process and then renamed,
+    so that concurrent processes never read a partial file nor write into the same one
+    '''
+    fd, tmp_path = tempfile.mkstemp(suffix='.tmp', prefix=os.path.basename(path) + '.', dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+        # mkstemp makes the file private, while the file it replaces follows the umask
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_path, 0o666 & ~umask)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def write_cache(cards: Dict[int, Tuple[List[int], List[int]]], path: str = CACHE_PATH):
+    data = {
+        'fingerprint': fingerprint(),
+        'cards': {validator_id: {'masks': [format(mask, 'x') for mask in masks], 'results': results} for validator_id, (masks, results) in sorted(cards.items())},
+    }
+    try:
+        replace_file(path, json.dumps(data))
+    except OSError:
+        pass
+
+_table: Dict[int, List[int]] = {}
+_results: Dict[int, List[int]] = {}
+_cache: Optional[Dict[int, Tuple[List[int], List[int]]]] = None
+
+_space_tables: Dict[CodeSpace, Dict[int, Tuple[List[int], List[int]]]] = {}
+
+def load_space_cards(validator_ids: Iterable[int], space: CodeSpace) -> Dict[int, Tuple[List[int], List[int]]]:
+    '''
+    returns { validator_id: ([criterion mask, ...], [number of codes, ...]) } of cards in a code space
+    other than the default one, compiled from their expressions
+    '''
+    from criterion_dsl import compile_mask
+    table = _space_tables.setdefault(space, {})
+    for validator_id in validator_ids:
+        if validator_id not in table:
+            masks = [compile_mask(criterion, space) for criterion in CRITERIONS[validator_id]]
+            table[validator_id] = (masks, [popcount(mask) for mask in masks])
+    return {validator_id: table[validator_id] for validator_id in validator_ids}
+
+
+def load_criterion_table(validator_ids: Optional[Iterable[int]] = None, path: str = CACHE_PATH, space: CodeSpace = DEFAULT_SPACE) -> Dict[int, List[int]]:
+    '''
+    returns { validator_id: [criterion mask, ...] } of validator_ids (all cards if None), loaded
+    from the disk cache; cards missing from it are compiled and then added to it
+    '''
+    global _cache
+    validator_ids = list(VALIDATORS) if validator_ids is None else list(validator_ids)
+    if space is not DEFAULT_SPACE:
+        return {validator_id: masks for validator_id, (masks, _) in load_space_cards(validator_ids, space).items()}
+    missing = [validator_id for validator_id in validator_ids if validator_id not in _table]
+    if missing:
+        if _cache is None:
+            _cache = read_cache(path)
+        compiled = False
+        for validator_id in missing:
+            if validator_id not in _cache:
+                masks = compile_card(validator_id)
+                _cache[validator_id] = (masks, [popcount(mask) for mask in masks])
+                compiled = True
+            _table[validator_id], _results[validator_id] = _cache[validator_id]
+        if compiled:
+            write_cache(_cache, path)
+    return {validator_id: _table[validator_id] for validator_id in validator_ids}
+
+
+# cards that are not in constants.py => criterion expressions, see criterion_dsl.add_card
+CUSTOM_CARDS: Dict[int, List[str]] = {}
+
+def add_compiled_card(validator_id: int, criterions: List[str], masks: List[int]):
+    '''
+    adds a custom card, which is never written to the disk cache
+    '''
+    CUSTOM_CARDS[validator_id] = criterions
+    _table[validator_id] = masks
+    _results[validator_id] = [popcount(mask) for mask in masks]
+
+
+def load_criterion_results(validator_ids: Optional[Iterable[int]] = None, path: str = CACHE_PATH, space: CodeSpace = DEFAULT_SPACE) -> Dict[int, List[int]]:
+    '''
+    returns { validator_id: [number of codes that satisfy the criterion, ...] } of validator_ids (all cards if None)
+    '''
+    if space is not DEFAULT_SPACE:
+        return {validator_id: results for validator_id, (_, results) in load_space_cards(list(VALIDATORS) if validator_ids is None else validator_ids, space).items()}
+    validator_ids = list(load_criterion_table(validator_ids, path))
+    return {validator_id: _results[validator_id] for validator_id in validator_ids}
+
+
+def verify(path: str = CACHE_PATH) -> List[str]:
+    '''
+    returns errors found by checking the criterions in constants.py and the disk cache against them
+    '''
+    errors = []
+    for validator_id in MUTUALLY_EXCLUSIVE_VALIDATORS:
+        if not is_mutually_exclusive(VALIDATORS[validator_id]):
+            errors.append(f'card {validator_id}: criterions are not mutually exclusive')
+    table = compile_validators()
+    for validator_id, masks in table.items():
+        if validator_id not in CRITERIONS:
+            errors.append(f'card {validator_id}: no criterion expressions')
+        elif len(CRITERIONS[validator_id]) != len(masks) or compile_card(validator_id) != masks:
+            errors.append(f'card {validator_id}: criterion expressions differ from lambdas')
+        for i, mask in enumerate(masks):
+            if mask == 0:
+                errors.append(f'card {validator_id}: criterion {i} is satisfied by no code')
+        if len(set(masks)) < len(masks):
+            errors.append(f'card {validator_id}: criterions are duplicated')
+    for validator_id in CRITERIONS.keys() - table.keys():
+        errors.append(f'card {validator_id}: no lambdas')
+    errors += verify_numpy()
+    for validator_id, (masks, results) in read_cache(path).items():
+        if validator_id not in table:
+            errors.append(f'card {validator_id}: unknown card in cache')
+        elif masks != table[validator_id] or results != [popcount(mask) for mask in table[validator_id]]:
+            errors.append(f'card {validator_id}: cache is out of date')
+    return errors
+
+
+def verify_numpy() -> List[str]:
+    '''
+    returns errors found by checking NumPy evaluators of criterion expressions against their masks,
+    or no errors if NumPy is not installed
+    '''
+    try:
+        import numpy as np
+    except ImportError:
+        return []
+    from criterion_dsl import compile_mask, compile_numpy
+
+    errors = []
+    t, s, c = np.array(CODES).T
+    for validator_id, criterions in CRITERIONS.items():
+        for i, criterion in enumerate(criterions):
+            satisfied = compile_numpy(criterion)(t, s, c)
+            if sum([1 << k for k in np.flatnonzero(satisfied).tolist()]) != compile_mask(criterion):
+                errors.append(f'card {validator_id}: NumPy evaluator of criterion {i} differs from its mask')
+    return errors
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['build', 'verify'])
+    parser.add_argument('--path', default=CACHE_PATH, help='criterion table cache')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        load_criterion_table(path=args.path)
+        print(f'Compiled {len(VALIDATORS)} cards into {args.path}')
+    else:
+        errors = verify(args.path)
+        for error in errors:
+            print(error, file=sys.stderr)
+        if errors:
+            sys.exit(1)
+        print(f'{len(VALIDATORS)} cards OK')
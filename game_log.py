@@ -0,0 +1,241 @@
+'''
+Game logs: record, resume and replay games.
+
+A game is logged as one JSON line holding what is needed to set up its solver
+again and the answers given so far, e.g.
+
+    {"cards": [4, 9, 11, 14], "mode": "classic", "history": "111:A0B0C1 245:A1"}
+
+`history` lists the rounds, each as its code, `:`, and the validator letter and
+result (1 or 0) of each question. Consecutive questions with the same code are
+one round, as in the history printed by the solver. Code digits are written
+without separators, or separated by `-` if digits can exceed 9. Optional fields:
+ - `filter_unique_answer`, `filter_useless_validators`: only if false
+ - `space`: `[digits, values]` of a variant
+ - `custom_cards`: `{ "card number": ["criterion", ...] }` of the custom cards of the game
+ - `hidden`: the true hidden, if known (e.g. in batch mode)
+ - `code`: the solved code
+
+A logged game is resumed by applying all of its answers at once (see
+`Solver.replay`). `replay` reads archives of logs, e.g. written by
+`batch.py --log`, and writes one JSON record per game with the remaining
+hiddens after each round and the information each round's query was expected
+to give; with `--compare`, also the information of the best query at that
+state, searched with exact scoring. Games run in a pool of processes, and
+games of the same cards share their filtered hiddens.
+
+Usage:
+    python turing_machine_solver.py 4 9 11 14 --log game.jsonl
+    python turing_machine_solver.py --resume game.jsonl
+    python game_log.py replay games.jsonl --compare --workers 4
+'''
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Iterator, List, Sequence, Tuple
+
+from criterion_table import CUSTOM_CARDS, DEFAULT_SPACE, CodeSpace, code_space, replace_file
+
+History = List[Tuple[Tuple[int, ...], int, bool]]
+
+
+def encode_code(code: Sequence[int], space: CodeSpace = DEFAULT_SPACE) -> str:
+    return ('-' if space.values > 9 else '').join([str(x) for x in code])
+
+
+def decode_code(text: str, space: CodeSpace = DEFAULT_SPACE) -> Tuple[int, ...]:
+    code = tuple([int(x) for x in (text.split('-') if '-' in text else text)])
+    if code not in space.code_indices:
+        raise ValueError(f'Invalid code: {text}')
+    return code
+
+
+def encode_history(history: History, space: CodeSpace = DEFAULT_SPACE) -> str:
+    from turing_machine_solver import group_rounds
+
+    return ' '.join([encode_code(code, space) + ':' + ''.join([chr(v + ord('A')) + str(int(r)) for v, r in questions]) for code, questions in group_rounds(history)])
+
+
+def decode_history(text: str, space: CodeSpace = DEFAULT_SPACE) -> History:
+    history = []
+    for round in text.split():
+        code, _, questions = round.partition(':')
+        code = decode_code(code, space)
+        if not questions or len(questions) % 2 != 0 or any([r not in '01' for r in questions[1::2]]):
+            raise ValueError(f'Invalid round: {round}')
+        history.extend([(code, ord(v) - ord('A'), r == '1') for v, r in zip(questions[::2], questions[1::2])])
+    return history
+
+
+def game_record(solver: 'Solver', **fields) -> dict:
+    '''
+    returns the log of a game, with fields such as hidden added
+    '''
+    record = { 'cards': solver.validator_ids, 'mode': solver.mode, 'history': encode_history(solver.history, solver.space) }
+    if not solver.filter_unique_answer:
+        record['filter_unique_answer'] = False
+    if not solver.filter_useless_validators:
+        record['filter_useless_validators'] = False
+    if solver.space is not DEFAULT_SPACE:
+        record['space'] = [solver.space.digits, solver.space.values]
+    custom_cards = {str(card): CUSTOM_CARDS[card] for card in solver.validator_ids if card in CUSTOM_CARDS}
+    if custom_cards:
+        record['custom_cards'] = custom_cards
+    record.update(fields)
+    if solver.solved():
+        record['code'] = list(solver.hidden_and_codes[0][1])
+    return record
+
+
+def new_solver(record: dict, **kwargs) -> 'Solver':
+    '''
+    returns a solver of the game of a log before any answer; the game settings of the log replace the ones in kwargs
+    '''
+    from criterion_dsl import add_card
+    from turing_machine_solver import Solver
+
+    space = code_space(*record['space']) if 'space' in record else DEFAULT_SPACE
+    for card, criterions in record.get('custom_cards', {}).items():
+        add_card(int(card), criterions, space)
+    for name in ['mode', 'filter_unique_answer', 'filter_useless_validators', 'space']:
+        kwargs.pop(name, None)
+    if space is not DEFAULT_SPACE:
+        kwargs['space'] = space
+    return Solver(record['cards'], mode=record.get('mode', 'classic'), filter_unique_answer=record.get('filter_unique_answer', True), filter_useless_validators=record.get('filter_useless_validators', True), **kwargs)
+
+
+def resume(record: dict, **kwargs) -> 'Solver':
+    '''
+    returns a solver of the game of a log, with all of its answers applied
+    '''
+    solver = new_solver(record, **kwargs)
+    solver.replay(decode_history(record['history'], solver.space))
+    return solver
+
+
+def write_log(path: str, record: dict):
+    '''
+    replaces the log of a game, so that it is complete even if the process is killed while writing
+    '''
+    replace_file(path, json.dumps(record) + '\n')
+
+
+def read_logs(lines: Iterable[str]) -> Iterator[dict]:
+    for line in lines:
+        line = line.strip()
+        if line and not line.startswith('#'):
+            yield json.loads(line)
+
+
+def read_log(path: str) -> dict:
+    '''
+    returns the last game logged in path
+    '''
+    with open(path) as f:
+        records = list(read_logs(f))
+    if not records:
+        raise ValueError(f'No game in {path}')
+    return records[-1]
+
+
+_cache = None
+
+def analyze(record: dict, compare: bool = False) -> dict:
+    '''
+    replays a logged game round by round; returns its rounds, questions and, for each round, the remaining hiddens
+    after it and the information its query was expected to give, and with compare the information of the best query
+    '''
+    from state_cache import StateCache
+    from turing_machine_solver import Solver, group_rounds
+
+    global _cache
+    if _cache is None:
+        # filtered hiddens of games of the same cards are enumerated once
+        _cache = StateCache()
+    solver = new_solver(record, scoring='exact' if compare else 'entropy', cache=_cache)
+    history = decode_history(record['history'], solver.space)
+
+    hiddens = [len(solver.hidden_and_codes)]
+    information = []
+    best_information = []
+    for code, questions in group_rounds(history):
+        hidden_set = solver.hidden_set(solver.hidden_and_codes)
+        k = solver.space.code_indices[code]
+        cells = [hidden_set]
+        for v, _ in questions:
+            answer_set = solver.pattern_hidden_mask(v, solver.game.validators[v].pattern(k))
+            cells = [cell for part in cells for cell in (part & answer_set, part & ~answer_set) if cell]
+        information.append(solver.information(cells))
+        if compare:
+            top = solver.top_queries(hidden_set, 1) if len(solver.hidden_and_codes) > 1 else []
+            best_information.append(top[0][1] if top else 0.0)
+        solver.replay([(code, v, r) for v, r in questions])
+        hiddens.append(len(solver.hidden_and_codes))
+
+    result = {
+        'cards': record['cards'],
+        'mode': record.get('mode', 'classic'),
+        'rounds': len(information),
+        'questions': len(history),
+        'solved': solver.solved(),
+        'code': list(solver.hidden_and_codes[0][1]) if solver.solved() else None,
+        'hiddens': hiddens,
+        'information': information,
+    }
+    if compare:
+        result['best_information'] = best_information
+    if 'hidden' in record:
+        # hiddens that no question can tell apart are kept once, so the code is compared rather than the hidden
+        true_code = Solver.check_hidden_possible(tuple(record['hidden']), solver.game.validators, solver.filter_unique_answer)
+        result['correct'] = solver.solved() and solver.hidden_and_codes[0][1] == true_code
+    return result
+
+
+def _analyze(task: Tuple[dict, bool]) -> dict:
+    return analyze(*task)
+
+
+def replay(records: Iterable[dict], *, compare: bool = False, workers: int = 1, batch_size: int = 4096) -> Iterator[dict]:
+    '''
+    yields analyze() of each logged game, in order
+    '''
+    from turing_machine_solver import map_in_batches
+
+    tasks = ((record, compare) for record in records)
+    if workers <= 1:
+        yield from map(_analyze, tasks)
+        return
+    with ProcessPoolExecutor(workers) as executor:
+        yield from map_in_batches(executor, _analyze, tasks, batch_size, chunksize=64)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    replay_parser = subparsers.add_parser('replay', help='replay logged games and measure their queries')
+    replay_parser.add_argument('logs', help='file of game logs, - for stdin')
+    replay_parser.add_argument('--compare', action='store_true', help='also measure the best query of each round')
+    replay_parser.add_argument('--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    n = solved = rounds = questions = 0
+    information = best_information = 0.0
+    with open(args.logs) if args.logs != '-' else sys.stdin as f:
+        for result in replay(read_logs(f), compare=args.compare, workers=args.workers):
+            print(json.dumps(result), flush=True)
+            n += 1
+            solved += result['solved']
+            rounds += result['rounds']
+            questions += result['questions']
+            information += sum(result['information'])
+            best_information += sum(result.get('best_information', []))
+
+    if n > 0:
+        summary = f'{n} games, {solved} solved, {rounds / n:.3f} rounds and {questions / n:.3f} questions on average'
+        if rounds > 0:
+            summary += f', {information / rounds:.3f} bits per round'
+            if args.compare:
+                summary += f' ({best_information / rounds:.3f} with the best queries)'
+        print(summary, file=sys.stderr)
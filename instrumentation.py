@@ -0,0 +1,98 @@
+'''
+Counters, per-stage timers and optional profiling for the solver.
+
+A stage is a timed block (e.g. hidden enumeration, next query). When it ends,
+one record with its wall time, the counters incremented during it and, if
+memory tracing is on, its peak memory, is passed to `emit` (if any). The solver
+always counts into an Instrumentation; counters are only added once per call of
+a hot function, so they are cheap enough to keep on.
+'''
+import argparse
+import collections
+import contextlib
+import cProfile
+import json
+import logging
+import sys
+import time
+import tracemalloc
+from typing import Callable, Dict, Iterator, Optional
+
+LOG_LEVELS = {
+    'debug': logging.DEBUG,
+    'info': logging.INFO,
+    'warning': logging.WARNING,
+}
+
+
+class Instrumentation:
+    def __init__(self, *, emit: Optional[Callable[[dict], None]] = None, trace_memory: bool = False, profile: bool = False) -> None:
+        self.emit = emit
+        self.trace_memory = trace_memory
+        self.counters: Dict[str, int] = collections.Counter()
+        self.timers: Dict[str, float] = collections.defaultdict(float)
+        self.profile = cProfile.Profile() if profile else None
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if self.profile is not None:
+            self.profile.enable()
+
+    def count(self, name: str, n: int = 1):
+        self.counters[name] += n
+
+    @contextlib.contextmanager
+    def stage(self, name: str, **fields) -> Iterator[dict]:
+        '''
+        times a block; more fields can be added to the yielded record before the block ends
+        '''
+        record = { 'stage': name }
+        record.update(fields)
+        counters = self.counters.copy()
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            elapsed = time.perf_counter() - start
+            self.timers[name] += elapsed
+            record['time'] = elapsed
+            record['counters'] = { key: value - counters.get(key, 0) for key, value in self.counters.items() if value != counters.get(key, 0) }
+            if self.trace_memory:
+                record['peak_memory'] = tracemalloc.get_traced_memory()[1]
+            if self.emit is not None:
+                self.emit(record)
+
+    def summary(self) -> dict:
+        return { 'counters': dict(self.counters), 'timers': dict(self.timers) }
+
+    def close(self, profile_path: Optional[str] = None):
+        '''
+        stops profiling; writes profile stats to profile_path, or prints the top functions to stderr
+        '''
+        if self.profile is not None:
+            self.profile.disable()
+            if profile_path:
+                self.profile.dump_stats(profile_path)
+            else:
+                import pstats
+                pstats.Stats(self.profile, stream=sys.stderr).sort_stats('cumulative').print_stats(20)
+            self.profile = None
+        if self.trace_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+
+def add_instrumentation_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--log-level', choices=LOG_LEVELS.keys(), default='debug', help='info hides the listings of hiddens and queries')
+    parser.add_argument('--quiet', action='store_true', help='only print one JSON record per stage')
+    parser.add_argument('--trace-memory', action='store_true', help='record peak memory of each stage')
+    parser.add_argument('--profile', nargs='?', const='', default=None, metavar='PATH', help='profile with cProfile, writing stats to PATH or printing them to stderr')
+
+
+def instrumentation_from_args(args: argparse.Namespace) -> Instrumentation:
+    '''
+    configures logging to stdout and returns instrumentation as requested by args
+    '''
+    logging.basicConfig(stream=sys.stdout, format='%(message)s', level=logging.WARNING if args.quiet else LOG_LEVELS[args.log_level])
+    emit = (lambda record: print(json.dumps(record), flush=True)) if args.quiet else None
+    return Instrumentation(emit=emit, trace_memory=args.trace_memory, profile=args.profile is not None)
@@ -0,0 +1,97 @@
+'''
+Optional NumPy backend for enumerating possible hiddens.
+
+Criterion masks are packed into little-endian byte rows, so that bit `k` of a
+row is code `space.codes[k]`. All hiddens are expanded one validator at a time by
+broadcasting, and hiddens that are left without any code are dropped before
+the next validator is expanded.
+'''
+from typing import List, Optional, Sequence, Tuple
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from criterion_table import CODES
+
+N_BYTES = (len(CODES) + 7) // 8
+
+
+def available() -> bool:
+    return np is not None
+
+
+def pack_masks(masks: Sequence[int], n_bytes: int = N_BYTES) -> 'np.ndarray':
+    '''
+    returns uint8 array of shape (len(masks), n_bytes)
+    '''
+    return np.frombuffer(b''.join([mask.to_bytes(n_bytes, 'little') for mask in masks]), dtype=np.uint8).reshape(len(masks), n_bytes)
+
+
+_popcount_table = None
+
+def count_codes(packed: 'np.ndarray') -> 'np.ndarray':
+    global _popcount_table
+    if _popcount_table is None:
+        _popcount_table = np.array([bin(i).count('1') for i in range(256)], dtype=np.int32)
+    return _popcount_table[packed].sum(axis=-1)
+
+
+def first_codes(packed: 'np.ndarray', n_codes: int = len(CODES)) -> 'np.ndarray':
+    return np.unpackbits(packed, axis=-1, count=n_codes, bitorder='little').argmax(axis=-1)
+
+
+def find_hidden_and_codes(validators: Sequence['Validator'], filter_unique_answer: bool, filter_useless_validators: bool, instrumentation: Optional['Instrumentation'] = None) -> Tuple[List[Tuple[Tuple[int, ...], Tuple[int, ...]]], Optional[List[int]]]:
+    '''
+    returns possible hiddens and their codes, in the same order as itertools.product,
+    and for each of them the first useless validator (-1 if none), or None if not filter_useless_validators
+    '''
+    if np is None:
+        raise ImportError('numpy backend requires numpy')
+
+    space = validators[0].space
+    n_bytes = (len(space.codes) + 7) // 8
+    packed = [pack_masks(validator.masks, n_bytes) for validator in validators]
+
+    # expand hiddens validator by validator, dropping hiddens with no code left
+    hiddens = np.zeros((1, 0), dtype=np.int64)
+    codes = np.full((1, n_bytes), 0xff, dtype=np.uint8)
+    evaluations = 0
+    pruned_branches = 0
+    for masks in packed:
+        n = len(masks)
+        codes = (codes[:, None, :] & masks[None, :, :]).reshape(-1, n_bytes)
+        hiddens = np.concatenate([np.repeat(hiddens, n, axis=0), np.tile(np.arange(n), len(hiddens))[:, None]], axis=1)
+        alive = codes.any(axis=1)
+        evaluations += len(codes)
+        pruned_branches += len(codes) - int(alive.sum())
+        codes, hiddens = codes[alive], hiddens[alive]
+
+    counts = count_codes(codes)
+    possible = counts == 1 if filter_unique_answer else counts > 0
+    if instrumentation is not None:
+        instrumentation.count('criterion evaluations', evaluations + (2 * len(packed) * int(possible.sum()) if filter_useless_validators else 0))
+        instrumentation.count('empty branches pruned', pruned_branches)
+        instrumentation.count('hiddens pruned by unique filter', len(possible) - int(possible.sum()))
+    codes, hiddens = codes[possible], hiddens[possible]
+    hidden_and_codes = [(tuple([int(i) for i in hidden]), space.codes[k]) for hidden, k in zip(hiddens, first_codes(codes, len(space.codes)))]
+
+    if not filter_useless_validators:
+        return hidden_and_codes, None
+
+    useless = np.full(len(hiddens), -1, dtype=np.int64)
+    if len(validators) > 1:
+        # prefixes[v] & suffixes[v + 1] is the code set of all validators except v
+        prefixes = [np.full((len(hiddens), n_bytes), 0xff, dtype=np.uint8)]
+        for v, masks in enumerate(packed):
+            prefixes.append(prefixes[-1] & masks[hiddens[:, v]])
+        suffixes = [np.full((len(hiddens), n_bytes), 0xff, dtype=np.uint8)]
+        for v in reversed(range(len(packed))):
+            suffixes.append(suffixes[-1] & packed[v][hiddens[:, v]])
+        suffixes.reverse()
+        for v in reversed(range(len(packed))):
+            others = count_codes(prefixes[v] & suffixes[v + 1])
+            is_useless = others == 1 if filter_unique_answer else others > 0
+            useless[is_useless] = v
+    return hidden_and_codes, [int(v) for v in useless]
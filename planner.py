@@ -0,0 +1,139 @@
+'''
+Multi-round lookahead planner.
+
+Searches a decision tree over several rounds on the remaining hiddens and scores
+a query by the number of rounds and questions still needed to solve the game,
+compared lexicographically (rounds first), either in expectation over the
+remaining hiddens, weighted by the solver's prior, or in the worst case. Candidate queries of each state come from
+the solver's own query enumeration, restricted to the ones with greatest entropy.
+Costs are cached per (hidden set, depth), and a query is abandoned as soon as a
+lower bound of its cost cannot beat the best query found so far.
+'''
+import math
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from constants import QUESTIONS_PER_ROUND
+from criterion_table import popcount
+
+# (rounds, questions)
+Cost = Tuple[float, float]
+Query = List[Tuple[Sequence[bool], int]]
+
+
+class Planner:
+    def __init__(self, solver: 'Solver', depth: int, *, width: int = 8, worst_case: bool = False) -> None:
+        self.solver = solver
+        self.depth = depth
+        self.width = width
+        self.worst_case = worst_case
+        self.cache: Dict[Tuple[int, int], Cost] = {}
+
+    def candidates(self, hidden_set: int) -> List[Tuple[Query, float]]:
+        '''
+        returns queries with greatest entropy for hidden_set, best first
+        '''
+        return self.solver.top_queries(hidden_set, self.width)
+
+    def split(self, hidden_set: int, query: Query) -> List[Tuple[int, int]]:
+        '''
+        returns hidden sets that a round of query can end with, and the number of questions asked to reach each;
+        like the interactive loop, questions that do not split the remaining hiddens are skipped
+        '''
+        parts = [(hidden_set, 0)]
+        for rs, v in query:
+            mask = self.solver.pattern_hidden_mask(v, rs)
+            next_parts = []
+            for part, questions in parts:
+                part_if_true = part & mask
+                if popcount(part) <= 1 or part_if_true == 0 or part_if_true == part:
+                    next_parts.append((part, questions))
+                    continue
+                next_parts.append((part_if_true, questions + 1))
+                next_parts.append((part ^ part_if_true, questions + 1))
+            parts = next_parts
+        return parts
+
+    @staticmethod
+    def estimate(n: int) -> Cost:
+        '''
+        lower bound of cost to solve n hiddens, since each question gives at most one bit
+        '''
+        if n <= 1:
+            return (0.0, 0.0)
+        bits = math.log2(n)
+        return (max(1.0, bits / QUESTIONS_PER_ROUND), bits)
+
+    def lower_bound(self, hidden_set: int, n: int) -> Cost:
+        '''
+        lower bound of cost to solve hidden_set of n hiddens; in expectation under a prior that is not uniform,
+        the number of questions is bounded by the entropy of the prior instead
+        '''
+        if n <= 1 or self.worst_case or self.solver.weight_classes is None:
+            return Planner.estimate(n)
+        bits = self.solver.hidden_entropy(hidden_set)
+        return (max(1.0, bits / QUESTIONS_PER_ROUND), bits)
+
+    def cost(self, hidden_set: int, depth: int) -> Cost:
+        '''
+        returns cost of solving hidden_set, searching depth rounds ahead
+        '''
+        n = popcount(hidden_set)
+        if n <= 1:
+            return (0.0, 0.0)
+        if depth == 0:
+            return self.lower_bound(hidden_set, n)
+        key = (hidden_set, depth)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+        self.solver.instrumentation.count('planner states expanded')
+
+        best = None
+        for query, _ in self.candidates(hidden_set):
+            cost = self.query_cost(hidden_set, query, depth, best)
+            if cost is not None and (best is None or cost < best):
+                best = cost
+        if best is None:
+            best = self.lower_bound(hidden_set, n)
+        self.cache[key] = best
+        return best
+
+    def query_cost(self, hidden_set: int, query: Query, depth: int, bound: Optional[Cost] = None) -> Optional[Cost]:
+        '''
+        returns cost of asking query in this round and then playing best for depth - 1 rounds,
+        or None if it cannot be less than bound
+        '''
+        n = self.solver.hidden_weight(hidden_set)
+        parts = sorted([(popcount(part), part, questions) for part, questions in self.split(hidden_set, query)], reverse=True)
+        weights = [self.solver.hidden_weight(part) for _, part, _ in parts]
+        # lower bounds of each part, replaced by exact costs one by one, largest part first
+        costs = []
+        for size, part, questions in parts:
+            rounds_left, questions_left = self.lower_bound(part, size)
+            costs.append((rounds_left, questions + questions_left))
+
+        def total() -> Cost:
+            if self.worst_case:
+                rounds, questions = max(costs)
+            else:
+                rounds = sum([cost[0] * weight for cost, weight in zip(costs, weights)]) / n
+                questions = sum([cost[1] * weight for cost, weight in zip(costs, weights)]) / n
+            return (1.0 + rounds, questions)
+
+        for k, (size, part, questions) in enumerate(parts):
+            if bound is not None and total() >= bound:
+                return None
+            if size <= 1:
+                continue
+            rounds_left, questions_left = self.cost(part, depth - 1)
+            costs[k] = (rounds_left, questions + questions_left)
+        cost = total()
+        if bound is not None and cost >= bound:
+            return None
+        return cost
+
+    def rank(self, hidden_set: int, queries: Sequence[Query]) -> List[Cost]:
+        '''
+        returns cost of each of queries for hidden_set, searching self.depth rounds ahead
+        '''
+        return [self.query_cost(hidden_set, query, self.depth) for query in queries]
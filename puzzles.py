@@ -0,0 +1,318 @@
+'''
+Puzzle generator and validity checker.
+
+A puzzle is a set of validator cards and a hidden (criterion index of each
+card) such that exactly one code satisfies all criterions and no criterion is
+superfluous, i.e. no card can be left out and still leave exactly one code.
+
+`generate` sweeps combinations of cards and writes one JSON line per valid
+puzzle, `{"cards": [...], "hidden": [...], "code": [...]}`, or, with
+`--format text`, the puzzle lines of batch.py. Combinations are swept depth
+first in ascending card order, so that combinations sharing their first cards
+share the code sets of their hiddens so far, and a partial hidden is dropped as
+soon as no code is left or exactly one code is left before the last card (every
+further card would be superfluous). The sweep is split into tasks, one per
+combination of the first cards, which run in a pool of processes.
+
+With `--difficulty`, each card set with valid puzzles is solved for every one of
+them, and each puzzle gets the number of `rounds` the solver takes and the
+`difficulty` of its card set, the expected rounds over its puzzles.
+`--min-rounds` and `--max-rounds` keep card sets by difficulty.
+
+With `--checkpoint`, the number of finished tasks and the size of the output
+are saved after each task, and a later run with the same arguments resumes from
+there, truncating the puzzles of an unfinished task.
+
+`check` reads puzzles, as JSON lines or batch.py lines, and prints the invalid
+ones with the reason; it exits with 1 if there are any.
+
+Usage:
+    python puzzles.py generate --sizes 4 5 --workers 4 --output puzzles.jsonl --checkpoint puzzles.checkpoint
+    python puzzles.py generate --sizes 4 --difficulty --min-rounds 3 --format text --output hard.txt
+    python puzzles.py check hard.txt
+'''
+import argparse
+import itertools
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from typing import IO, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from constants import VALIDATORS
+from criterion_table import DEFAULT_SPACE, CodeSpace, fingerprint, load_criterion_table, lowest_bit, popcount
+
+# number of cards chosen within a task, the others are the prefix of the task
+TASK_CARDS = 3
+
+Puzzle = Tuple[Tuple[int, ...], Tuple[int, ...], Tuple[int, ...]]
+Task = Tuple[int, Tuple[int, ...]]
+
+
+def iter_tasks(card_ids: Sequence[int], sizes: Sequence[int]) -> Iterator[Task]:
+    '''
+    yields (size, first cards) of each task, in the order of the combinations of card_ids
+    '''
+    card_ids = sorted(card_ids)
+    for size in sizes:
+        n_prefix = max(size - TASK_CARDS, 1) if size > 1 else 0
+        for prefix in itertools.combinations(card_ids[:len(card_ids) - (size - n_prefix)], n_prefix):
+            yield size, prefix
+
+
+def sweep(card_ids: Sequence[int], size: int, prefix: Tuple[int, ...]) -> Iterator[Puzzle]:
+    '''
+    yields the valid puzzles of all combinations of size cards of card_ids that start with prefix,
+    in the order of itertools.combinations and then of itertools.product of criterion indices
+    '''
+    from turing_machine_solver import Solver, load_validator
+
+    card_ids = sorted(card_ids)
+    table = load_criterion_table(card_ids)
+    cards = list(prefix)
+    # (partial hidden, its code set) of cards
+    partials = [((), DEFAULT_SPACE.all_codes_mask)]
+
+    def extend(partials: List[Tuple[Tuple[int, ...], int]], card: int, last: bool) -> List[Tuple[Tuple[int, ...], int]]:
+        result = []
+        for hidden, mask in partials:
+            for i, criterion_mask in enumerate(table[card]):
+                mask_i = mask & criterion_mask
+                # with one code left, any further card is superfluous
+                if mask_i and (last or popcount(mask_i) > 1):
+                    result.append((hidden + (i,), mask_i))
+        return result
+
+    def search(start: int, partials: List[Tuple[Tuple[int, ...], int]]) -> Iterator[Puzzle]:
+        if len(cards) == size:
+            validators = [load_validator([(card, i) for i in range(len(VALIDATORS[card]))]) for card in cards]
+            for hidden, mask in partials:
+                if popcount(mask) == 1 and Solver.find_useless_validator(validators, hidden, True) < 0:
+                    yield tuple(cards), hidden, DEFAULT_SPACE.codes[lowest_bit(mask)]
+            return
+        for j in range(start, len(card_ids) - (size - len(cards)) + 1):
+            extended = extend(partials, card_ids[j], len(cards) == size - 1)
+            if not extended:
+                continue
+            cards.append(card_ids[j])
+            yield from search(j + 1, extended)
+            cards.pop()
+
+    for k, card in enumerate(prefix):
+        partials = extend(partials, card, k == size - 1)
+        if not partials:
+            return
+    yield from search(card_ids.index(prefix[-1]) + 1 if prefix else 0, partials)
+
+
+_cache = None
+
+def solve_rounds(validator_ids: Sequence[int], hidden_and_codes: List[Tuple[Tuple[int, ...], Tuple[int, ...]]]) -> List[int]:
+    '''
+    returns the number of rounds the solver takes for each of the filtered hiddens of a game
+    '''
+    from state_cache import StateCache
+    from turing_machine_solver import Solver, play
+
+    global _cache
+    if _cache is None:
+        # every game of a card set starts from the same states, so queries are searched once
+        _cache = StateCache()
+    rounds = []
+    for hidden, _ in hidden_and_codes:
+        solver = Solver(validator_ids, hidden_and_codes=hidden_and_codes, cache=_cache)
+        rounds.append(play(solver, lambda code, v: solver.game.validate(v, code, hidden)))
+    return rounds
+
+
+def run_task(task: Tuple[Sequence[int], int, Tuple[int, ...], bool, float, float]) -> List[dict]:
+    '''
+    returns the records of the valid puzzles of a task, with their difficulty if asked for
+    '''
+    card_ids, size, prefix, difficulty, min_rounds, max_rounds = task
+    records = []
+    for cards, puzzles in itertools.groupby(sweep(card_ids, size, prefix), key=lambda puzzle: puzzle[0]):
+        puzzles = list(puzzles)
+        card_records = [{ 'cards': list(cards), 'hidden': list(hidden), 'code': list(code) } for _, hidden, code in puzzles]
+        if difficulty:
+            rounds = solve_rounds(cards, [(hidden, code) for _, hidden, code in puzzles])
+            expected_rounds = sum(rounds) / len(rounds)
+            if not min_rounds <= expected_rounds <= max_rounds:
+                continue
+            for record, r in zip(card_records, rounds):
+                record['rounds'] = r
+                record['difficulty'] = expected_rounds
+        records.extend(card_records)
+    return records
+
+
+def format_record(record: dict, format: str) -> str:
+    if format == 'text':
+        from batch import format_puzzle
+        return format_puzzle(record['cards'], record['hidden'])
+    return json.dumps(record)
+
+
+def read_checkpoint(path: str, settings: dict) -> Tuple[int, int, int]:
+    '''
+    returns the number of finished tasks, the size of the output and the number of puzzles written,
+    or zeros if there is no checkpoint; raises ValueError if it was saved with other settings
+    '''
+    if not os.path.exists(path):
+        return 0, 0, 0
+    with open(path) as f:
+        checkpoint = json.load(f)
+    if checkpoint['settings'] != settings:
+        raise ValueError(f'{path} was saved with other settings: {checkpoint["settings"]}')
+    return checkpoint['tasks'], checkpoint['offset'], checkpoint['puzzles']
+
+
+def write_checkpoint(path: str, settings: dict, tasks: int, offset: int, puzzles: int):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({ 'settings': settings, 'tasks': tasks, 'offset': offset, 'puzzles': puzzles }, f)
+    os.replace(tmp_path, path)
+
+
+def generate(output: IO[str], card_ids: Sequence[int], sizes: Sequence[int], *, difficulty: bool = False, min_rounds: float = 0, max_rounds: float = float('inf'), format: str = 'json', workers: int = 1, checkpoint: Optional[str] = None, batch_size: int = 64) -> int:
+    '''
+    writes valid puzzles of all combinations of sizes cards to output, returns number of puzzles written;
+    with checkpoint, resumes from and saves to that file, output must then be a file opened for appending
+    '''
+    card_ids = sorted(card_ids)
+    settings = { 'cards': card_ids, 'sizes': list(sizes), 'difficulty': difficulty, 'min_rounds': min_rounds, 'max_rounds': max_rounds if max_rounds != float('inf') else None, 'format': format, 'fingerprint': fingerprint() }
+    done, offset, n = read_checkpoint(checkpoint, settings) if checkpoint is not None else (0, 0, 0)
+    if checkpoint is not None:
+        # drop puzzles of the task that was running when the checkpoint was saved
+        output.truncate(offset)
+        output.seek(offset)
+    tasks = ((card_ids, size, prefix, difficulty, min_rounds, max_rounds) for size, prefix in itertools.islice(iter_tasks(card_ids, sizes), done, None))
+
+    def write(results: Iterable[List[dict]]) -> int:
+        nonlocal done, n
+        for records in results:
+            for record in records:
+                output.write(format_record(record, format) + '\n')
+            output.flush()
+            done += 1
+            n += len(records)
+            if checkpoint is not None:
+                write_checkpoint(checkpoint, settings, done, output.tell(), n)
+        return n
+
+    if workers <= 1:
+        return write(map(run_task, tasks))
+    from turing_machine_solver import map_in_batches
+    with ProcessPoolExecutor(workers) as executor:
+        # finished tasks are written in order
+        return write(map_in_batches(executor, run_task, tasks, batch_size))
+
+
+def read_puzzles(lines: Iterable[str]) -> Iterator[Tuple[List[int], Tuple[int, ...], Optional[Tuple[int, ...]]]]:
+    '''
+    yields cards, hidden and code (None if not given) of JSON or batch.py puzzle lines
+    '''
+    from batch import parse_puzzles
+
+    for line in lines:
+        if line.lstrip().startswith('{'):
+            record = json.loads(line)
+            yield record['cards'], tuple(record['hidden']), tuple(record['code']) if record.get('code') is not None else None
+        else:
+            for cards, hidden in parse_puzzles([line]):
+                yield cards, hidden, None
+
+
+def load_prior(path: str) -> Dict[Tuple[int, ...], Dict[Tuple[int, ...], int]]:
+    '''
+    returns the numbers of puzzles of a file, as { sorted card ids: { hidden in sorted card order: count } },
+    which is a prior of published puzzles for Solver
+    '''
+    prior = {}
+    with open(path) as f:
+        for validator_ids, hidden, _ in read_puzzles(f):
+            order = sorted(range(len(validator_ids)), key=lambda v: validator_ids[v])
+            counts = prior.setdefault(tuple([validator_ids[v] for v in order]), {})
+            key = tuple([hidden[v] for v in order])
+            counts[key] = counts.get(key, 0) + 1
+    return prior
+
+
+def check_puzzle(validator_ids: Sequence[int], hidden: Sequence[int], code: Optional[Sequence[int]] = None, *, mode: str = 'classic', filter_unique_answer: bool = True, filter_useless_validators: bool = True, space: CodeSpace = DEFAULT_SPACE) -> Optional[str]:
+    '''
+    returns why a puzzle is invalid, or None if it is valid; with the filters off, a puzzle only needs hidden to
+    give at least one code
+    '''
+    from turing_machine_solver import MODES, Game, Solver
+
+    if mode not in MODES:
+        return f'unknown mode {mode}'
+    unknown = [card for card in validator_ids if card not in VALIDATORS]
+    if unknown:
+        return f'unknown cards {unknown}'
+    if len(set(validator_ids)) != len(validator_ids):
+        return 'duplicated cards'
+    if mode == 'extreme' and len(validator_ids) % 2 != 0:
+        return 'extreme mode needs two cards per validator'
+    game = Game(validator_ids, mode, space)
+    if len(hidden) != len(game.validators) or not all([0 <= i < len(validator.masks) for validator, i in zip(game.validators, hidden)]):
+        return 'hidden does not match cards'
+    if mode == 'nightmare' and len(set([game.options[v][i][0] for v, i in enumerate(hidden)])) != len(hidden):
+        return 'validators share a card'
+    n_codes = popcount(Solver.hidden_mask(game.validators, hidden))
+    if n_codes == 0 or filter_unique_answer and n_codes != 1:
+        return f'{n_codes} codes satisfy all criterions'
+    if code is not None and n_codes == 1:
+        true_code = Solver.check_hidden_possible(hidden, game.validators, True)
+        if tuple(code) != true_code:
+            return f'code is {true_code}'
+    v = Solver.find_useless_validator(game.validators, hidden, filter_unique_answer) if filter_useless_validators else -1
+    if v >= 0:
+        return f'validator {chr(v + ord("A"))} (card {game.options[v][hidden[v]][0]}) is superfluous'
+    return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    generate_parser = subparsers.add_parser('generate', help='write the valid puzzles of every combination of cards')
+    generate_parser.add_argument('--sizes', nargs='+', type=int, default=[4, 5, 6])
+    generate_parser.add_argument('--cards', nargs='+', type=int, default=sorted(VALIDATORS.keys()), help='cards to combine')
+    generate_parser.add_argument('--difficulty', action='store_true', help='solve each puzzle and add rounds and the expected rounds of its card set')
+    generate_parser.add_argument('--min-rounds', type=float, default=0, help='keep card sets with at least this difficulty, implies --difficulty')
+    generate_parser.add_argument('--max-rounds', type=float, default=float('inf'), help='keep card sets with at most this difficulty, implies --difficulty')
+    generate_parser.add_argument('--format', choices=['json', 'text'], default='json', help='text: puzzle lines of batch.py')
+    generate_parser.add_argument('--output', help='output file, stdout if not given')
+    generate_parser.add_argument('--checkpoint', help='resume from and save progress to this file, needs --output')
+    generate_parser.add_argument('--workers', type=int, default=os.cpu_count())
+    check_parser = subparsers.add_parser('check', help='print the invalid puzzles of a file')
+    check_parser.add_argument('puzzles', help='puzzle file, JSON lines or batch.py lines, - for stdin')
+    args = parser.parse_args()
+
+    if args.command == 'generate':
+        if args.checkpoint and not args.output:
+            parser.error('--checkpoint needs --output')
+        difficulty = args.difficulty or args.min_rounds > 0 or args.max_rounds != float('inf')
+        kwargs = dict(difficulty=difficulty, min_rounds=args.min_rounds, max_rounds=args.max_rounds, format=args.format, workers=args.workers, checkpoint=args.checkpoint)
+        if args.output:
+            # appending keeps the puzzles of finished tasks when resuming
+            with open(args.output, 'a+' if args.checkpoint else 'w') as f:
+                try:
+                    n = generate(f, args.cards, args.sizes, **kwargs)
+                except ValueError as e:
+                    print(e, file=sys.stderr)
+                    sys.exit(1)
+            print(f'{n} puzzles written to {args.output}', file=sys.stderr)
+        else:
+            generate(sys.stdout, args.cards, args.sizes, **kwargs)
+    else:
+        n = invalid = 0
+        with open(args.puzzles) if args.puzzles != '-' else sys.stdin as f:
+            for validator_ids, hidden, code in read_puzzles(f):
+                n += 1
+                reason = check_puzzle(validator_ids, hidden, code)
+                if reason is not None:
+                    invalid += 1
+                    print(' '.join([str(x) for x in validator_ids]), ':', ' '.join([str(x) for x in hidden]), '=>', reason)
+        print(f'{n - invalid}/{n} puzzles valid', file=sys.stderr)
+        sys.exit(1 if invalid else 0)
@@ -0,0 +1,406 @@
+'''
+Solver service hosting many concurrent games.
+
+A long-lived asyncio server that speaks line-delimited JSON over TCP: each
+request is one JSON object on a line, answered by one JSON object on a line.
+
+    {"op": "start", "cards": [4, 9, 11, 14]}                  => {"session": 1, "hiddens": 2, "solved": false}
+    {"op": "next_query", "session": 1}                        => {"query": [[[1, 1, 1], 0]]}
+    {"op": "answer", "session": 1, "code": [1, 1, 1], "validator": 0, "result": false}
+                                                              => {"hiddens": 1, "solved": true, "code": [2, 4, 1], "query": []}
+    {"op": "log", "session": 1}                               => {"log": {"cards": [4, 9, 11, 14], "mode": "classic", "history": "111:A0", "code": [2, 4, 1]}}
+    {"op": "close", "session": 1}                             => {}
+    {"op": "stats"}                                           => {"sessions": 0, "games": 1, "cache": {"hits": 3, "misses": 5, ...}}
+
+`start` also takes `mode` and the solver options `filter_unique_answer`,
+`filter_useless_validators`, `lookahead`, `lookahead_width`,
+`lookahead_worst_case`, `replan`, `scoring` and `engine`, and `history`, the
+answers of a game to resume as in a game log (see game_log.py), e.g. the log
+of a session before the service restarted. After an answer, `query` holds the
+rest of the round. `stats` sums the state cache statistics of the workers (see
+state_cache.py), as of the last search of each. Errors are answered as
+{"error": message}.
+
+Validators are shared by all sessions, and hiddens of each game are enumerated
+once, for the SERVICE_GAMES most recently started games. Enumeration and query
+searches run in a bounded process pool, where each worker keeps a solver per
+game and search options and is sent the remaining hiddens as a bitset, so slow
+searches do not block other sessions. Workers cache the best query of each
+state they have searched, so that sessions of the same puzzle reuse it.
+
+Sessions are closed with the connection that started them, or after
+`--session-timeout` seconds without requests.
+
+Usage:
+    python service.py serve --port 8765 --workers 4
+    python service.py load-test --port 8765 --sessions 200 --concurrency 16
+'''
+import argparse
+import asyncio
+import collections
+import itertools
+import json
+import logging
+import os
+import random
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from constants import VALIDATORS
+from criterion_dsl import CUSTOM_CARDS, add_card, load_cards
+from criterion_table import CODE_INDICES, iter_bits
+from game_log import decode_history, game_record
+from state_cache import StateCache
+from turing_machine_solver import MODES, Game, Solver, logger as solver_logger
+
+# cards, mode, filter_unique_answer, filter_useless_validators
+GameKey = Tuple[Tuple[int, ...], str, bool, bool]
+# game and the search options of a session, as sorted (name, value) pairs
+SolverKey = Tuple[GameKey, Tuple[Tuple[str, object], ...]]
+HiddenAndCodes = List[Tuple[Tuple[int, ...], Tuple[int, int, int]]]
+Query = List[Tuple[Tuple[int, int, int], int]]
+
+SEARCH_OPTIONS = ['lookahead', 'lookahead_width', 'lookahead_worst_case', 'replan', 'scoring', 'engine']
+# number of solvers, of games and search options, each worker keeps
+WORKER_GAMES = 64
+# number of games whose filtered hiddens the service keeps
+SERVICE_GAMES = 256
+
+
+_worker_solvers: 'collections.OrderedDict[SolverKey, Solver]' = collections.OrderedDict()
+# best queries of states seen by this worker, shared by its solvers
+_worker_cache = StateCache()
+
+def _init_worker(cards: Dict[int, List[str]]):
+    solver_logger.setLevel(logging.WARNING)
+    for card, criterions in cards.items():
+        add_card(card, criterions)
+
+def _game_solver(key: GameKey, options: dict) -> Solver:
+    '''
+    returns the worker's solver of a game with search options; solvers of the same game share filtered hiddens
+    and best queries through the worker's cache, whose keys include the search options
+    '''
+    solver_key = (key, tuple(sorted(options.items())))
+    solver = _worker_solvers.get(solver_key)
+    if solver is None:
+        cards, mode, filter_unique_answer, filter_useless_validators = key
+        solver = Solver(cards, mode=mode, filter_unique_answer=filter_unique_answer, filter_useless_validators=filter_useless_validators, cache=_worker_cache, **options)
+        _worker_solvers[solver_key] = solver
+        if len(_worker_solvers) > WORKER_GAMES:
+            _worker_solvers.popitem(last=False)
+    _worker_solvers.move_to_end(solver_key)
+    return solver
+
+def _restore(key: GameKey, hidden_set: int, options: dict) -> Solver:
+    '''
+    returns the worker's solver of a game with search options, left with the hiddens in hidden_set
+    '''
+    solver = _game_solver(key, options)
+    solver.hidden_and_codes = [solver.indexed_hidden_and_codes[k] for k in iter_bits(hidden_set)]
+    return solver
+
+def _run_with_stats(fn, *args) -> Tuple[int, Dict[str, int], object]:
+    '''
+    returns the worker's process id and cache statistics along with fn(*args)
+    '''
+    result = fn(*args)
+    return os.getpid(), _worker_cache.stats(), result
+
+def _start_game(key: GameKey) -> HiddenAndCodes:
+    return _game_solver(key, {}).indexed_hidden_and_codes
+
+def _find_query(key: GameKey, hidden_set: int, options: dict) -> Query:
+    return _restore(key, hidden_set, options).next_query()
+
+def _replan_query(key: GameKey, hidden_set: int, options: dict, code: Tuple[int, int, int], asked: List[int]) -> Query:
+    return _restore(key, hidden_set, options).replan_query(code, asked)
+
+
+class Session:
+    def __init__(self, key: GameKey, solver: Solver, options: dict) -> None:
+        self.key = key
+        self.solver = solver
+        self.options = options
+        # rest of the current round
+        self.code: Optional[Tuple[int, int, int]] = None
+        self.query: Query = []
+        self.asked: List[int] = []
+        self.lock = asyncio.Lock()
+        self.last_used = time.monotonic()
+
+
+class Service:
+    def __init__(self, workers: int, max_pending: int, session_timeout: float = 600) -> None:
+        self.executor = ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(dict(CUSTOM_CARDS),))
+        # searches waiting for or running in the pool
+        self.pending = asyncio.Semaphore(max_pending)
+        # filtered hiddens of each game, in the order of the workers' solvers, least recently started first
+        self.games: 'collections.OrderedDict[GameKey, HiddenAndCodes]' = collections.OrderedDict()
+        self.sessions: Dict[int, Session] = {}
+        self.session_ids = itertools.count(1)
+        # sessions unused for this many seconds are closed
+        self.session_timeout = session_timeout
+        self.last_expiry = time.monotonic()
+        # cache statistics of each worker process, as of its last task
+        self.worker_stats: Dict[int, Dict[str, int]] = {}
+
+    async def run(self, fn, *args):
+        async with self.pending:
+            pid, stats, result = await asyncio.get_running_loop().run_in_executor(self.executor, _run_with_stats, fn, *args)
+        self.worker_stats[pid] = stats
+        return result
+
+    def stats(self) -> dict:
+        cache = collections.Counter()
+        for stats in self.worker_stats.values():
+            cache.update(stats)
+        return { 'sessions': len(self.sessions), 'games': len(self.games), 'cache': dict(cache) }
+
+    async def start(self, request: dict) -> dict:
+        mode = request.get('mode', 'classic')
+        if mode not in MODES:
+            raise ValueError(f'Unknown mode: {mode}')
+        for card in request['cards']:
+            if card not in VALIDATORS:
+                raise ValueError(f'Unknown card: {card}')
+        key = (tuple([int(card) for card in request['cards']]), mode, bool(request.get('filter_unique_answer', True)), bool(request.get('filter_useless_validators', True)))
+        options = {name: request[name] for name in SEARCH_OPTIONS if name in request}
+        self.expire_sessions()
+        hidden_and_codes = self.games.get(key)
+        if hidden_and_codes is None:
+            hidden_and_codes = await self.run(_start_game, key)
+            self.games[key] = hidden_and_codes
+            # sessions keep the hiddens of their game, so evicted games only have to be enumerated again
+            if len(self.games) > SERVICE_GAMES:
+                self.games.popitem(last=False)
+        self.games.move_to_end(key)
+        solver = Solver(key[0], mode=mode, filter_unique_answer=key[2], filter_useless_validators=key[3], hidden_and_codes=hidden_and_codes, **options)
+        if request.get('history'):
+            solver.replay(decode_history(request['history']))
+        session_id = next(self.session_ids)
+        self.sessions[session_id] = Session(key, solver, options)
+        return { 'session': session_id, 'hiddens': len(solver.hidden_and_codes), 'solved': solver.solved() }
+
+    def session(self, request: dict) -> Session:
+        session = self.sessions.get(request.get('session'))
+        if session is None:
+            raise ValueError(f'Unknown session: {request.get("session")}')
+        session.last_used = time.monotonic()
+        return session
+
+    def expire_sessions(self):
+        '''
+        closes sessions unused for session_timeout, checking at most every tenth of it
+        '''
+        now = time.monotonic()
+        if now - self.last_expiry < self.session_timeout / 10:
+            return
+        self.last_expiry = now
+        for session_id in [session_id for session_id, session in self.sessions.items() if now - session.last_used > self.session_timeout]:
+            del self.sessions[session_id]
+
+    async def next_query(self, session: Session) -> dict:
+        solver = session.solver
+        if solver.solved() or not solver.hidden_and_codes:
+            return { 'query': [] }
+        query = await self.run(_find_query, session.key, solver.hidden_set(solver.hidden_and_codes), session.options)
+        session.code = query[0][0] if query else None
+        session.query = list(query)
+        session.asked = []
+        return { 'query': [[list(code), v] for code, v in query] }
+
+    async def answer(self, session: Session, request: dict) -> dict:
+        solver = session.solver
+        code = tuple([int(x) for x in request['code']])
+        if code not in CODE_INDICES:
+            raise ValueError(f'Unknown code: {list(code)}')
+        v = int(request['validator'])
+        if not 0 <= v < len(solver.game.validators):
+            raise ValueError(f'Unknown validator: {v}')
+        solver.update_question_result(code, v, bool(request['result']))
+
+        if code != session.code:
+            # answer to a question of the client's own choice ends the round
+            session.code = None
+            session.query = []
+        else:
+            session.asked.append(v)
+            session.query = [(c, vv) for c, vv in session.query if vv != v]
+            if solver.solved():
+                session.query = []
+            elif solver.replan:
+                session.query = await self.run(_replan_query, session.key, solver.hidden_set(solver.hidden_and_codes), session.options, code, session.asked)
+            else:
+                session.query = [(c, vv) for c, vv in session.query if solver.check_should_query(c, vv)]
+
+        response = { 'hiddens': len(solver.hidden_and_codes), 'solved': solver.solved(), 'query': [[list(c), vv] for c, vv in session.query] }
+        if solver.solved():
+            response['code'] = list(solver.hidden_and_codes[0][1])
+        return response
+
+    async def handle(self, request: dict, started: Optional[List[int]] = None) -> dict:
+        '''
+        answers a request; sessions started are added to started
+        '''
+        if not isinstance(request, dict):
+            raise ValueError('Request must be a JSON object')
+        op = request.get('op')
+        if op == 'start':
+            response = await self.start(request)
+            if started is not None:
+                started.append(response['session'])
+            return response
+        if op == 'close':
+            self.sessions.pop(request.get('session'), None)
+            return {}
+        if op == 'stats':
+            return self.stats()
+        session = self.session(request)
+        async with session.lock:
+            if op == 'next_query':
+                return await self.next_query(session)
+            if op == 'answer':
+                return await self.answer(session, request)
+            if op == 'log':
+                return { 'log': game_record(session.solver) }
+        raise ValueError(f'Unknown op: {op}')
+
+    async def serve_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        # sessions of this connection, closed with it
+        started = []
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    response = await self.handle(json.loads(line), started)
+                except KeyError as e:
+                    response = { 'error': f'Missing field: {e.args[0]}' }
+                except (ValueError, TypeError) as e:
+                    response = { 'error': str(e) }
+                writer.write(json.dumps(response).encode() + b'\n')
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            for session_id in started:
+                self.sessions.pop(session_id, None)
+            writer.close()
+
+    def close(self):
+        self.executor.shutdown()
+
+
+async def serve(host: str, port: int, workers: int, max_pending: int, session_timeout: float):
+    service = Service(workers, max_pending, session_timeout)
+    server = await asyncio.start_server(service.serve_client, host, port)
+    print(f'Serving on {host}:{port} with {workers} workers', file=sys.stderr)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        service.close()
+
+
+async def request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, message: dict) -> dict:
+    writer.write(json.dumps(message).encode() + b'\n')
+    await writer.drain()
+    response = json.loads(await reader.readline())
+    if 'error' in response:
+        raise RuntimeError(response['error'])
+    return response
+
+
+async def play_session(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, validator_ids: List[int], mode: str, hidden: Sequence[int], game: Game, latencies: List[float]) -> bool:
+    '''
+    plays one game through the service, answering from hidden; returns whether it was solved
+    '''
+    response = await request(reader, writer, { 'op': 'start', 'cards': validator_ids, 'mode': mode })
+    session_id = response['session']
+    solved = response['solved']
+    while not solved:
+        start = time.perf_counter()
+        query = (await request(reader, writer, { 'op': 'next_query', 'session': session_id }))['query']
+        latencies.append(time.perf_counter() - start)
+        if not query:
+            break
+        while query and not solved:
+            code, v = query[0]
+            response = await request(reader, writer, { 'op': 'answer', 'session': session_id, 'code': code, 'validator': v, 'result': game.validate(v, tuple(code), hidden) })
+            solved = response['solved']
+            query = response['query']
+    await request(reader, writer, { 'op': 'close', 'session': session_id })
+    return solved
+
+
+async def load_test(host: str, port: int, games: Dict[str, Tuple[List[int], str]], sessions: int, concurrency: int, seed: int):
+    # puzzles are drawn from the hiddens of each game, computed locally
+    puzzles = []
+    for validator_ids, mode in games.values():
+        solver = Solver(validator_ids, mode=mode)
+        game = Game(validator_ids, mode)
+        puzzles.extend([(validator_ids, mode, hidden, game) for hidden, _ in solver.hidden_and_codes])
+    rng = random.Random(seed)
+    queue = [rng.choice(puzzles) for _ in range(sessions)]
+    latencies = []
+    solved = 0
+
+    async def client():
+        nonlocal solved
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            while queue:
+                validator_ids, mode, hidden, game = queue.pop()
+                result = await play_session(reader, writer, validator_ids, mode, hidden, game, latencies)
+                solved += result
+        finally:
+            writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    def percentile(q: float) -> float:
+        return latencies[min(int(q * len(latencies)), len(latencies) - 1)] * 1000 if latencies else 0.0
+    print(f'{solved}/{sessions} sessions solved in {elapsed:.3f}s ({sessions / elapsed:.1f} sessions/s)')
+    print(f'next_query: {len(latencies)} requests, p50 {percentile(0.5):.3f} ms, p99 {percentile(0.99):.3f} ms, max {percentile(1.0):.3f} ms')
+
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        stats = await request(reader, writer, { 'op': 'stats' })
+    finally:
+        writer.close()
+    print('State cache:', ', '.join([f'{name} {value}' for name, value in stats['cache'].items()]))
+
+
+if __name__ == '__main__':
+    from benchmark import GAMES, MODES as GAME_MODES
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    serve_parser = subparsers.add_parser('serve', help='run the service')
+    serve_parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of processes for searches')
+    serve_parser.add_argument('--max-pending', type=int, default=256, help='number of searches queued or running, more wait')
+    serve_parser.add_argument('--cards', help='JSON file of custom validator cards, see criterion_dsl.py')
+    serve_parser.add_argument('--session-timeout', type=float, default=600, help='close sessions unused for this many seconds')
+    load_parser = subparsers.add_parser('load-test', help='play many sessions against a running service')
+    load_parser.add_argument('--games', nargs='+', choices=GAMES.keys(), default=[name for name in GAMES if name not in GAME_MODES])
+    load_parser.add_argument('--sessions', type=int, default=200)
+    load_parser.add_argument('--concurrency', type=int, default=16, help='number of connections playing at once')
+    load_parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        if args.cards:
+            load_cards(args.cards)
+        asyncio.run(serve(args.host, args.port, args.workers, args.max_pending, args.session_timeout))
+    else:
+        games = {name: (GAMES[name], GAME_MODES.get(name, 'classic')) for name in args.games}
+        asyncio.run(load_test(args.host, args.port, games, args.sessions, args.concurrency, args.seed))
@@ -0,0 +1,104 @@
+'''
+LRU cache of solver states.
+
+Maps a canonical state key to the filtered hiddens of a game, or to the best
+query for a set of remaining hiddens. Keys are strings built by the solver from
+the cards, mode, filters and search options of a game, and for queries from the
+remaining hiddens as a bitset, so that histories which leave the same hiddens
+share an entry. Values are JSON-serializable lists.
+
+Entries are kept in memory up to a number of entries and an estimated size in
+bytes, evicting the least recently used ones. If a path is given, entries are
+also written to an SQLite database, which is read on memory misses and survives
+restarts; it is cleared when the criterion table changes (see criterion_table.fingerprint).
+'''
+import collections
+import json
+import sqlite3
+from typing import Any, Dict, Optional, Tuple
+
+from criterion_table import fingerprint
+
+
+class StateCache:
+    def __init__(self, *, max_entries: int = 100000, max_bytes: int = 64 << 20, path: Optional[str] = None) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # key => (value, estimated size in bytes), least recently used first
+        self.entries: 'collections.OrderedDict[str, Tuple[Any, int]]' = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self.evictions = 0
+
+        self.path = path
+        self.db = None
+        if path is not None:
+            self.db = sqlite3.connect(path)
+            self.db.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS states (key TEXT PRIMARY KEY, value TEXT)')
+            row = self.db.execute("SELECT value FROM meta WHERE name = 'fingerprint'").fetchone()
+            if row is None or row[0] != fingerprint():
+                self.db.execute('DELETE FROM states')
+                self.db.execute("INSERT OR REPLACE INTO meta VALUES ('fingerprint', ?)", (fingerprint(),))
+            self.db.commit()
+
+    def get(self, key: str) -> Optional[Any]:
+        '''
+        returns cached value of key, or None
+        '''
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+        if self.db is not None:
+            row = self.db.execute('SELECT value FROM states WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                value = json.loads(row[0])
+                self.insert(key, value, len(key) + len(row[0]))
+                self.hits += 1
+                self.disk_hits += 1
+                return value
+        self.misses += 1
+        return None
+
+    def put(self, key: str, value: Any):
+        '''
+        caches value of key; value is kept as is, so it must not be modified afterwards
+        '''
+        data = json.dumps(value)
+        self.insert(key, value, len(key) + len(data))
+        if self.db is not None:
+            self.db.execute('INSERT OR REPLACE INTO states VALUES (?, ?)', (key, data))
+            self.db.commit()
+
+    def insert(self, key: str, value: Any, size: int):
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.bytes -= old[1]
+        if size > self.max_bytes:
+            # would evict everything else, only kept on disk
+            return
+        self.entries[key] = (value, size)
+        self.bytes += size
+        while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.bytes -= evicted_size
+            self.evictions += 1
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'disk_hits': self.disk_hits,
+            'evictions': self.evictions,
+            'entries': len(self.entries),
+            'bytes': self.bytes,
+        }
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
@@ -1,257 +1,1280 @@
+import collections
+import hashlib
+import heapq
 import itertools
+import json
+import logging
 import math
-from typing import Callable, List, Tuple, Iterable, Optional, Container, Sequence
+from typing import Callable, Dict, Iterator, List, Tuple, Iterable, Optional, Container, Sequence
 import argparse
 
+from instrumentation import Instrumentation, add_instrumentation_arguments, instrumentation_from_args
 from constants import NUMBERS, QUESTIONS_PER_ROUND, VALIDATORS
+from planner import Planner
+from criterion_table import CUSTOM_CARDS, DEFAULT_SPACE, CodeSpace, code_space, compile_criterion, iter_bits, load_criterion_results, load_criterion_table, lowest_bit, popcount
+
+
+BACKENDS = ['python', 'numpy']
+MODES = ['classic', 'extreme', 'nightmare']
+SCORINGS = ['entropy', 'exact']
+ENGINES = ['patterns', 'codes']
+PRIORS = ['hiddens', 'codes']
+# share of a prior of published puzzles spread over all hiddens, so that unpublished ones can still be solved
+PRIOR_SMOOTHING = 0.01
+# slack for rounding when comparing an entropy bound with an entropy
+ENTROPY_EPSILON = 1e-9
+
+logger = logging.getLogger('turing_machine_solver')
+
+
+def validator_names(vs: Iterable[int]) -> str:
+    return ' '.join([chr(v + ord('A')) for v in vs])
+
+
+def group_rounds(history: Iterable[Tuple[Tuple[int, ...], int, bool]]) -> List[Tuple[Tuple[int, ...], List[Tuple[int, bool]]]]:
+    '''
+    returns (code, [(validator, result), ...]) of each round of history, where consecutive questions with the same code are one round
+    '''
+    rounds = []
+    for query_code, query_v, query_r in history:
+        if len(rounds) > 0 and rounds[-1][0] == query_code and len(rounds[-1][1]) < QUESTIONS_PER_ROUND:
+            rounds[-1][1].append((query_v, query_r))
+        else:
+            rounds.append((query_code, [(query_v, query_r)]))
+    return rounds
 
 
 class Validator:
-    def __init__(self, criterions: Iterable[Callable[[int, int, int], bool]]):
+    def __init__(self, criterions: Iterable[Callable[..., bool]], masks: Optional[Sequence[int]] = None, results: Optional[Sequence[int]] = None, space: CodeSpace = DEFAULT_SPACE):
         self.criterions = list(criterions)
+        self.space = space
+        # masks[i] has bit k set iff space.codes[k] satisfies criterion i
+        self.masks = list(masks) if masks is not None else [compile_criterion(criterion) for criterion in self.criterions]
         self.results = {}
         for i in range(len(self.criterions)):
-            self.results[i] = { True: 0, False: 0 }
-            for code in itertools.product(NUMBERS, NUMBERS, NUMBERS):
-                r = criterions[i](*code)
-                self.results[i][r] += 1
-        
+            n_true = results[i] if results is not None else popcount(self.masks[i])
+            self.results[i] = { True: n_true, False: len(space.codes) - n_true }
+
+        # a pattern is the tuple of criterion results for a code
+        # pattern_masks maps each pattern to the codes that produce it, in order of first code;
+        # codes are split by one criterion at a time, so this takes no scan over codes
+        pattern_masks = {(): space.all_codes_mask}
+        for mask in self.masks:
+            split = {}
+            for rs, pattern_mask in pattern_masks.items():
+                if pattern_mask & mask:
+                    split[rs + (True,)] = pattern_mask & mask
+                if pattern_mask & ~mask:
+                    split[rs + (False,)] = pattern_mask & ~mask
+            pattern_masks = split
+        self.pattern_masks = dict(sorted(pattern_masks.items(), key=lambda item: lowest_bit(item[1])))
+
+    def pattern(self, k: int) -> Tuple[bool, ...]:
+        '''
+        returns the pattern of space.codes[k]
+        '''
+        return tuple([bool(mask >> k & 1) for mask in self.masks])
+
+    def check(self, i: int, code: Tuple[int, ...]) -> bool:
+        return bool(self.masks[i] >> self.space.code_indices[code] & 1)
+
+
+_validators: Dict[Tuple[CodeSpace, Tuple[Tuple[int, int], ...]], Validator] = {}
+
+def load_validator(options: Sequence[Tuple[int, int]], space: CodeSpace = DEFAULT_SPACE) -> Validator:
+    '''
+    returns the validator of options (card and criterion index of each criterion) in space,
+    which is built once and shared by all games since validators are never modified
+    '''
+    key = (space, tuple(options))
+    validator = _validators.get(key)
+    if validator is None:
+        options = key[1]
+        cards = {card for card, _ in options}
+        table = load_criterion_table(cards, space=space)
+        results = load_criterion_results(cards, space=space)
+        validator = Validator([VALIDATORS[card][i] for card, i in options], [table[card][i] for card, i in options], [results[card][i] for card, i in options], space)
+        _validators[key] = validator
+    return validator
+
 
 class Game:
-    def __init__(self, validator_ids: Iterable[int]) -> None:
-        self.validators = [Validator(VALIDATORS[validator_id]) for validator_id in validator_ids]
+    def __init__(self, validator_ids: Iterable[int], mode: str = 'classic', space: CodeSpace = DEFAULT_SPACE) -> None:
+        '''
+        classic: each validator checks one criterion of its card
+        extreme: validator_ids are pairs of cards, each validator checks one criterion of one card of its pair
+        nightmare: each validator checks one criterion of a different card, and which card is hidden too
+        '''
+        if mode not in MODES:
+            raise ValueError(f'Unknown mode: {mode}')
+        validator_ids = list(validator_ids)
+        self.mode = mode
+        self.space = space
+        if mode == 'extreme':
+            if len(validator_ids) % 2 != 0:
+                raise ValueError('Extreme mode needs two cards per validator')
+            slots = [validator_ids[v:v + 2] for v in range(0, len(validator_ids), 2)]
+        elif mode == 'nightmare':
+            slots = [validator_ids] * len(validator_ids)
+        else:
+            slots = [[validator_id] for validator_id in validator_ids]
+
+        # options[v][i] is the card and criterion index of criterion i of validator v
+        self.options = [[(card, i) for card in cards for i in range(len(VALIDATORS[card]))] for cards in slots]
+        self.validators = [load_validator(options, space) for options in self.options]
+        # validators of the cards themselves, whose hiddens are assigned to validators in nightmare mode
+        self.card_validators = [load_validator([(validator_id, i) for i in range(len(VALIDATORS[validator_id]))], space) for validator_id in validator_ids] if mode == 'nightmare' else self.validators
+        # offsets[j] is the option index of the first criterion of j-th card in nightmare mode
+        self.offsets = [sum([len(VALIDATORS[card]) for card in validator_ids[:j]]) for j in range(len(validator_ids))]
 
-    def validate(self, v: int, code: Tuple[int, int, int], answers: Iterable[int]) -> bool:
-        return self.validators[v].criterions[answers[v]](*code)
+    def validate(self, v: int, code: Tuple[int, ...], answers: Iterable[int]) -> bool:
+        return self.validators[v].check(answers[v], code)
+
+    def assign_cards(self, hidden_and_codes: Iterable[Tuple[Tuple[int, ...], Tuple[int, ...]]]) -> List[Tuple[Tuple[int, ...], Tuple[int, ...]]]:
+        '''
+        nightmare mode: turns hiddens of the cards into hiddens of the validators, one for each assignment of cards to validators,
+        in the same order as itertools.product; which code is unique and which criterion is useless does not depend on the assignment
+        '''
+        result = []
+        for hidden, code in hidden_and_codes:
+            # cards[v] is the card of validator v
+            for cards in itertools.permutations(range(len(hidden))):
+                result.append((tuple([self.offsets[j] + hidden[j] for j in cards]), code))
+        result.sort()
+        return result
+
+    def drop_indistinguishable(self, hidden_and_codes: Iterable[Tuple[Tuple[int, ...], Tuple[int, ...]]]) -> List[Tuple[Tuple[int, ...], Tuple[int, ...]]]:
+        '''
+        drops hiddens that no question can tell apart from an earlier one, i.e. whose validators check criterions
+        with the same codes, e.g. in extreme mode when both cards of a validator have the same criterion
+        '''
+        # same[v][i] is the first criterion of validator v with the same codes as criterion i
+        same = []
+        for validator in self.validators:
+            first = {}
+            same.append([first.setdefault(mask, i) for i, mask in enumerate(validator.masks)])
+        if all([indices == list(range(len(indices))) for indices in same]):
+            return list(hidden_and_codes)
+        seen = set()
+        result = []
+        for hidden, code in hidden_and_codes:
+            key = tuple([same[v][i] for v, i in enumerate(hidden)])
+            if key not in seen:
+                seen.add(key)
+                result.append((hidden, code))
+        return result
+
+    def describe(self, hidden: Sequence[int]) -> str:
+        '''
+        returns the card and criterion index checked by each validator
+        '''
+        return ', '.join([f'{chr(v + ord("A"))}: card {self.options[v][i][0]} criterion {self.options[v][i][1]}' for v, i in enumerate(hidden)])
 
 
 class Solver:
-    def __init__(self, validator_ids: Iterable[int], *, filter_unique_answer = True, filter_useless_validators = True) -> None:
+    def __init__(self, validator_ids: Iterable[int], *, mode = 'classic', filter_unique_answer = True, filter_useless_validators = True, backend = 'python', lookahead = 0, lookahead_width = 8, lookahead_worst_case = False, replan = True, scoring = 'entropy', prior = 'hiddens', engine = 'patterns', workers = 1, space = DEFAULT_SPACE, hidden_and_codes = None, book = None, cache = None, instrumentation = None) -> None:
         validator_ids = list(validator_ids)
-        self.game = Game(validator_ids)
+        self.validator_ids = validator_ids
+        self.instrumentation = instrumentation if instrumentation is not None else Instrumentation()
+        self.mode = mode
+        # codes of the game, 3 digits from 1 to 5 unless this is a variant
+        self.space = space
+        with self.instrumentation.stage('load validators', cards=validator_ids, mode=mode):
+            self.game = Game(validator_ids, mode, space)
         self.filter_unique_answer = filter_unique_answer
         self.filter_useless_validators = filter_useless_validators
         self.history = []
+        # number of rounds to plan ahead, 0 to pick the query with greatest entropy
+        self.lookahead = lookahead
+        self.lookahead_width = lookahead_width
+        self.lookahead_worst_case = lookahead_worst_case
+        # whether to pick the rest of a round again after each answer
+        self.replan = replan
+        # entropy: sum of the entropies of the questions of a round along each branch, each hidden equally likely
+        # exact: information of the joint answers of a round about the hidden, with hiddens weighted by prior
+        if scoring not in SCORINGS:
+            raise ValueError(f'Unknown scoring: {scoring}')
+        if isinstance(prior, str) and prior not in PRIORS:
+            raise ValueError(f'Unknown prior: {prior}')
+        if prior != 'hiddens' and scoring != 'exact':
+            raise ValueError('A prior needs exact scoring')
+        if not isinstance(prior, str) and mode != 'classic':
+            raise ValueError('A prior of published puzzles needs classic mode')
+        self.scoring = scoring
+        # patterns: search validators first and then the answer patterns of their criterions
+        # codes: search proposal codes first and then subsets of validators, with exact scoring
+        if engine not in ENGINES:
+            raise ValueError(f'Unknown engine: {engine}')
+        if engine == 'codes' and scoring != 'exact':
+            raise ValueError('The codes engine needs exact scoring')
+        self.engine = engine
+        # hiddens: uniform over hiddens, codes: uniform over codes and then over the hiddens of a code,
+        # or { sorted card ids: { hidden in sorted card order: number of published puzzles } }
+        self.prior = prior
+        # number of processes for query search
+        self.workers = workers
+        self.executor = None
+        # cache of filtered hiddens and best queries, see state_cache.py
+        self.cache = cache
+
+        if backend not in BACKENDS:
+            raise ValueError(f'Unknown backend: {backend}')
+        if backend == 'numpy':
+            # imported on demand, since importing numpy takes longer than solving most games
+            import numpy_backend
+            if not numpy_backend.available():
+                raise ImportError('numpy backend requires numpy')
         
-        print('Initializing solver for game:', validator_ids)
+        logger.info('Initializing solver for game: %s', validator_ids if mode == 'classic' else f'{validator_ids} ({mode})')
         for v in range(len(self.game.validators)):
-            print(chr(v + ord('A')), self.game.validators[v].results)
+            logger.info('%s %s', chr(v + ord('A')), self.game.validators[v].results)
+
+        # best first query, if known from book
+        self.book_query = None
+        if hidden_and_codes is None and book is not None and mode == 'classic' and space is DEFAULT_SPACE:
+            with self.instrumentation.stage('load book') as record:
+                hidden_and_codes = self.load_from_book(book)
+                record['found'] = hidden_and_codes is not None
+        if hidden_and_codes is None and cache is not None:
+            with self.instrumentation.stage('load cache') as record:
+                cached = cache.get(self.cache_key('hiddens'))
+                if cached is not None:
+                    hidden_and_codes = [(tuple(hidden), tuple(code)) for hidden, code in cached]
+                    logger.info('Loaded %d hiddens from cache', len(hidden_and_codes))
+                record['found'] = cached is not None
+                self.instrumentation.count('state cache hits' if cached is not None else 'state cache misses')
 
         # find all possible hiddens, and their codes
         # a hidden is a tuple of criterion indices
         # a possible hidden is a hidden that can uniquely determine an code, i.e. only one code can satisfy all validator criterions
-        self.hidden_and_codes = []
-        for hidden in itertools.product(*[range(len(validator.criterions)) for validator in self.game.validators]):
-            code = Solver.check_hidden_possible(hidden, self.game.validators, self.filter_unique_answer)
-            if code is not None:
-                self.hidden_and_codes.append((hidden, code))
-
-        print('Possible hiddens and corresponding codes:')
-        for hidden, code in self.hidden_and_codes:
-            print(' -', hidden, '=>', code)
-        print(f'({len(self.hidden_and_codes)} possible hiddens in total)')
-                
-        # filter useless validators
-        # a validator is useless if code can be uniquely determined by other validators
-        if self.filter_useless_validators:
-            print('Filtering hiddens by checking useless validators:')
-            self.hidden_and_codes = list(itertools.filterfalse(lambda h_o: self.has_useless_validators(h_o[0], h_o[1]), self.hidden_and_codes))
+        # in nightmare mode, hiddens of the cards are found first and then assigned to validators
+        if hidden_and_codes is not None:
+            # already filtered
+            self.hidden_and_codes = list(hidden_and_codes)
         else:
-            print('Skip filtering hiddens by checking useless validators')
+            with self.instrumentation.stage('enumerate hiddens', backend=backend) as record:
+                if backend == 'numpy':
+                    self.hidden_and_codes, useless = numpy_backend.find_hidden_and_codes(self.game.card_validators, self.filter_unique_answer, self.filter_useless_validators, self.instrumentation)
+                else:
+                    self.hidden_and_codes, useless = Solver.find_hidden_and_codes(self.game.card_validators, self.filter_unique_answer, self.filter_useless_validators, self.instrumentation)
+                record['hiddens'] = len(self.hidden_and_codes)
 
-        print('Filtered hiddens and corresponding codes:')
-        for hidden, code in self.hidden_and_codes:
-            print(' -', hidden, '=>', code)
-        print(f'({len(self.hidden_and_codes)} possible hiddens in total)')
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug('Possible hiddens and corresponding codes:')
+                for hidden, code in self.hidden_and_codes:
+                    logger.debug(' - %s => %s', hidden, code)
+            logger.info('(%d possible hiddens in total)', len(self.hidden_and_codes))
+
+            # filter useless validators
+            # a validator is useless if code can be uniquely determined by other validators
+            if self.filter_useless_validators:
+                with self.instrumentation.stage('filter useless') as record:
+                    logger.info('Filtering hiddens by checking useless validators:')
+                    if logger.isEnabledFor(logging.DEBUG):
+                        for (hidden, code), v in zip(self.hidden_and_codes, useless):
+                            if v >= 0:
+                                logger.debug(' - %s => %s [x] validator %s is useless', hidden, code, chr(v + ord('A')))
+                    n = len(self.hidden_and_codes)
+                    self.hidden_and_codes = [h_o for h_o, v in zip(self.hidden_and_codes, useless) if v < 0]
+                    self.instrumentation.count('hiddens pruned by useless filter', n - len(self.hidden_and_codes))
+                    record['hiddens'] = len(self.hidden_and_codes)
+            else:
+                logger.info('Skip filtering hiddens by checking useless validators')
+
+            if mode == 'nightmare':
+                with self.instrumentation.stage('assign cards') as record:
+                    self.hidden_and_codes = self.game.assign_cards(self.hidden_and_codes)
+                    record['hiddens'] = len(self.hidden_and_codes)
+
+            # otherwise the game could never be solved down to one hidden
+            n = len(self.hidden_and_codes)
+            self.hidden_and_codes = self.game.drop_indistinguishable(self.hidden_and_codes)
+            self.instrumentation.count('hiddens pruned as indistinguishable', n - len(self.hidden_and_codes))
+
+            if cache is not None:
+                cache.put(self.cache_key('hiddens'), list(self.hidden_and_codes))
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Filtered hiddens and corresponding codes:')
+            for hidden, code in self.hidden_and_codes:
+                logger.debug(' - %s => %s', hidden, code)
+        logger.info('(%d possible hiddens in total)', len(self.hidden_and_codes))
+        self.init_hidden_sets()
     
+    def load_from_book(self, book: 'Book') -> Optional[List[Tuple[Tuple[int, ...], Tuple[int, ...]]]]:
+        '''
+        returns filtered hiddens from book, or None if book does not have this game
+        '''
+        if not book.up_to_date() or book.filter_unique_answer != self.filter_unique_answer or book.filter_useless_validators != self.filter_useless_validators:
+            logger.warning('Skip book %s because it was built with different validators or filters', book.path)
+            return None
+        entry = book.lookup(self.validator_ids)
+        if entry is None:
+            return None
+        hidden_and_codes, query = entry
+
+        # book is keyed by sorted validator ids, order[j] is the validator of j-th sorted card
+        order = sorted(range(len(self.validator_ids)), key=lambda v: self.validator_ids[v])
+        def unsort(sorted_hidden: Sequence[int]) -> Tuple[int, ...]:
+            hidden = [0] * len(sorted_hidden)
+            for j, i in enumerate(sorted_hidden):
+                hidden[order[j]] = i
+            return tuple(hidden)
+        # same order as enumerated hiddens
+        hidden_and_codes = sorted([(unsort(hidden), code) for hidden, code in hidden_and_codes])
+        # the best query only holds for the same validator order, since ties are broken by order
+        if order == sorted(order) and query:
+            self.book_query = query
+        logger.info('Loaded %d hiddens from book %s', len(hidden_and_codes), book.path)
+        return hidden_and_codes
+
     def solved(self) -> bool:
         return len(self.hidden_and_codes) == 1
 
     def print_solved(self):
         hidden, code = self.hidden_and_codes[0]
-        print('Solved:')
-        print(' - hidden:', hidden)
-        print(' - code  :', code)
-
-        rounds = []
-        for query_code, query_v, query_r in self.history:
-            if len(rounds) > 0 and rounds[-1][0] == query_code and len(rounds[-1][1]) < 3:
-                rounds[-1][1].append((query_v, query_r))
-            else:
-                rounds.append((query_code, [(query_v, query_r)]))
-        
-        if not self.history:
-            print('Solved without asking questions')
-            return
-        
-        print('History:')
-        print('       ', *[chr(v + ord('A')) for v in range(len(self.game.validators))])
-        for round in rounds:
-            code, round_history = round
-            line = []
-            for v in range(len(self.game.validators)):
-                if (v, True) in round_history:
-                    line.append('V')
-                elif (v, False) in round_history:
-                    line.append('X')
-                else:
-                    line.append(' ')
-            print(*code, '|', *line)
-    
-    def next_query(self) -> List[Tuple[Tuple[int, int, int], int]]:
+        with self.instrumentation.stage('solved', hidden=list(hidden), code=list(code), questions=len(self.history)):
+            logger.info('Solved:')
+            logger.info(' - hidden: %s', hidden)
+            logger.info(' - code  : %s', code)
+            if self.mode != 'classic':
+                logger.info(' - cards : %s', self.game.describe(hidden))
+
+            rounds = group_rounds(self.history)
+            if not self.history:
+                logger.info('Solved without asking questions')
+                return
+
+            logger.info('History:')
+            logger.info('%s%s', ' ' * (len(' '.join([str(x) for x in rounds[0][0]])) + 3), validator_names(range(len(self.game.validators))))
+            for round in rounds:
+                code, round_history = round
+                line = []
+                for v in range(len(self.game.validators)):
+                    if (v, True) in round_history:
+                        line.append('V')
+                    elif (v, False) in round_history:
+                        line.append('X')
+                    else:
+                        line.append(' ')
+                logger.info('%s | %s', ' '.join([str(x) for x in code]), ' '.join(line))
+
+    def next_query(self) -> List[Tuple[Tuple[int, ...], int]]:
         '''
         returns best query: codes and validator_ids
         '''
         if len(self.hidden_and_codes) == 0:
-            print('Error: Game not valid because no possible hiddens')
+            logger.error('Error: Game not valid because no possible hiddens')
             return []
         if self.solved():
             self.print_solved()
             return []
 
-        print('Find all possible queries:')
-        all_queries = self.recursively_find_queries([], self.hidden_and_codes, 0.0, 1.0)
-        if len(all_queries) == 0:
-            print('Error: no valid query found')
-        
-        all_queries.sort(key=lambda x: x[1], reverse=True)
+        with self.instrumentation.stage('next query', hiddens=len(self.hidden_and_codes)) as record:
+            query = self.find_best_query()
+            record['query'] = [[list(code), v] for code, v in query]
+        return query
+
+    def find_best_query(self) -> List[Tuple[Tuple[int, ...], int]]:
+        if self.book_query is not None and not self.history and self.lookahead == 0 and self.scoring == 'entropy':
+            code = self.book_query[0][0]
+            logger.info('[Query] %s %s from book', code, validator_names([v for _, v in self.book_query]))
+            return list(self.book_query)
+
+        if self.cache is None:
+            return self.search_best_query()
+        key = self.query_cache_key()
+        cached = self.cache.get(key)
+        if cached is not None:
+            self.instrumentation.count('state cache hits')
+            query = [(tuple(code), v) for code, v in cached]
+            if query:
+                logger.info('[Query] %s %s from cache', query[0][0], validator_names([v for _, v in query]))
+            return query
+        self.instrumentation.count('state cache misses')
+        query = self.search_best_query()
+        self.cache.put(key, list(query))
+        return query
+
+    def cache_key(self, *parts) -> str:
+        # numbers of custom cards are chosen by users, so their criterions are part of the key
+        custom_cards = [CUSTOM_CARDS[card] for card in self.validator_ids if card in CUSTOM_CARDS]
+        space = [self.space.digits, self.space.values] if self.space is not DEFAULT_SPACE else []
+        return json.dumps([self.validator_ids, self.mode, self.filter_unique_answer, self.filter_useless_validators, *parts] + ([custom_cards] if custom_cards else []) + ([space] if space else []))
+
+    def query_cache_key(self) -> str:
+        '''
+        returns key of the best query for the remaining hiddens, which does not depend on the order of answers;
+        hiddens are indexed, so the key also has a digest of the indexed hiddens
+        '''
+        if self.hidden_and_codes_digest is None:
+            self.hidden_and_codes_digest = hashlib.sha1(repr(self.indexed_hidden_and_codes).encode()).hexdigest()
+        search = [self.lookahead, self.lookahead_width, self.lookahead_worst_case] if self.lookahead > 0 else [0]
+        if self.scoring != 'entropy':
+            prior = self.prior if isinstance(self.prior, str) else hashlib.sha1(repr(self.weight_classes).encode()).hexdigest()
+            search += [self.scoring, prior]
+        if self.engine != 'patterns':
+            # ties between queries are broken in another order
+            search += [self.engine]
+        return self.cache_key('query', self.hidden_and_codes_digest, search, hex(self.hidden_set(self.hidden_and_codes)))
+
+    def search_best_query(self) -> List[Tuple[Tuple[int, ...], int]]:
+        logger.debug('Find all possible queries:')
+        self.query_cache = {}
+        self.question_bounds_cache = {}
+        # only as many queries as are printed or planned with are kept
+        k = self.lookahead_width if self.lookahead > 0 else 1
+        if logger.isEnabledFor(logging.DEBUG):
+            k = max(k, 10)
+        top_queries = self.top_queries(self.hidden_set(self.hidden_and_codes), k)
+        if len(top_queries) == 0:
+            logger.error('Error: no valid query found')
+            return []
+
         # print top 10 queries
-        for queries, entropy in all_queries[:10]:
-            print(' -', self.find_code_for_query(queries), *[chr(vv + ord('A')) for _, vv in queries], f'=> {entropy:.6f}')
-        if len(all_queries) > 10:
-            print(f' - ... ({len(all_queries)} in total)')
-        queries, entropy = all_queries[0]
+        if logger.isEnabledFor(logging.DEBUG):
+            for queries, entropy in top_queries[:10]:
+                logger.debug(' - %s %s => %.6f', self.find_code_for_query(queries), validator_names([vv for _, vv in queries]), entropy)
+        queries, entropy = top_queries[0]
+        cost = None
+
+        if self.lookahead > 0 and len(top_queries) > 1:
+            objective = 'worst-case' if self.lookahead_worst_case else 'expected'
+            logger.debug('Planning %d rounds ahead (%s rounds and questions):', self.lookahead, objective)
+            planner = Planner(self, self.lookahead, width=self.lookahead_width, worst_case=self.lookahead_worst_case)
+            candidates = top_queries[:self.lookahead_width]
+            costs = planner.rank(self.hidden_set(self.hidden_and_codes), [queries for queries, _ in candidates])
+            if logger.isEnabledFor(logging.DEBUG):
+                for (queries, entropy), (rounds, questions) in zip(candidates, costs):
+                    logger.debug(' - %s %s => %.6f, %.3f rounds, %.3f questions', self.find_code_for_query(queries), validator_names([vv for _, vv in queries]), entropy, rounds, questions)
+            best = min(range(len(candidates)), key=lambda k: costs[k])
+            queries, entropy = candidates[best]
+            cost = costs[best]
 
         code = self.find_code_for_query(queries)
         if code is not None:
-            print('[Query]', code, *[chr(v + ord('A')) for _, v in queries], f'which has entropy {entropy:.6f}')
+            if cost is not None:
+                logger.info('[Query] %s %s which has entropy %.6f and %s cost %.3f rounds, %.3f questions', code, validator_names([v for _, v in queries]), entropy, objective, cost[0], cost[1])
+            else:
+                logger.info('[Query] %s %s which has entropy %.6f', code, validator_names([v for _, v in queries]), entropy)
             return [(code, v) for _, v in queries]
         return []
 
-    def update_question_result(self, query_code: Tuple[int, int, int], query_v: int, query_r: bool):
-        print('Updating question:', chr(query_v + ord('A')), query_code, '=>', r)
-        self.history.append((query_code, query_v, query_r))
-        self.hidden_and_codes = [(h, op) for h, op in self.hidden_and_codes if self.game.validators[query_v].criterions[h[query_v]](*query_code) == query_r]
-        for hidden, code in self.hidden_and_codes:
-            print(' -', hidden, '=>', code)
-        print(f'({len(self.hidden_and_codes)} possible hiddens left)')
-        
-    def check_should_query(self, code: Tuple[int, int, int], v: int):
-        rs = tuple([criterion(*code) for criterion in self.game.validators[v].criterions])
+    def replan_query(self, code: Tuple[int, ...], asked: Sequence[int]) -> List[Tuple[Tuple[int, ...], int]]:
+        '''
+        returns best questions to ask in the rest of a round with code, after validators in asked have been asked;
+        the state reached in the search tree of the round is usually cached already, so this is not a new search
+        '''
+        if self.solved() or len(asked) >= QUESTIONS_PER_ROUND:
+            return []
+        with self.instrumentation.stage('replan', asked=list(asked), hiddens=len(self.hidden_and_codes)) as record:
+            k = self.space.code_indices[code]
+            queried = 0
+            previous_mask = self.space.all_codes_mask
+            for v in asked:
+                queried |= 1 << v
+                previous_mask &= self.game.validators[v].pattern_masks[self.game.validators[v].pattern(k)]
+
+            best = None
+            if self.scoring == 'exact':
+                # searched over the patterns of this code only
+                if self.engine == 'codes':
+                    suffixes = self.iter_code_queries(self.hidden_set(self.hidden_and_codes), queried, [k])
+                else:
+                    suffixes = self.iter_exact_queries(self.hidden_set(self.hidden_and_codes), queried, 1 << k)
+                for suffix, information in suffixes:
+                    if best is None or information > best[1]:
+                        best = (suffix, information)
+            else:
+                # only suffixes that keep the same code
+                for suffix, terms in self.find_query_suffixes(self.hidden_set(self.hidden_and_codes), queried, previous_mask):
+                    if any([rs != self.game.validators[v].pattern(k) for rs, v in suffix]):
+                        continue
+                    entropy = terms[0]
+                    for term in terms[1:]:
+                        entropy += term
+                    if best is None or entropy > best[1]:
+                        best = (suffix, entropy)
+            query = [(code, v) for _, v in best[0]] if best is not None else []
+            record['query'] = [[list(code), v] for code, v in query]
+
+        if query:
+            logger.info('[Replan] %s %s which has entropy %.6f', code, validator_names([v for _, v in query]), best[1])
+        else:
+            logger.info('[Replan] %s no useful question left in this round', code)
+        return query
+
+    def update_question_result(self, query_code: Tuple[int, ...], query_v: int, query_r: bool):
+        with self.instrumentation.stage('update', question=[list(query_code), query_v], result=query_r) as record:
+            logger.info('Updating question: %s %s => %s', chr(query_v + ord('A')), query_code, query_r)
+            self.history.append((query_code, query_v, query_r))
+            rs = self.game.validators[query_v].pattern(self.space.code_indices[query_code])
+            n = len(self.hidden_and_codes)
+            self.hidden_and_codes = [(h, op) for h, op in self.hidden_and_codes if rs[h[query_v]] == query_r]
+            self.instrumentation.count('hiddens pruned by answers', n - len(self.hidden_and_codes))
+            record['hiddens'] = len(self.hidden_and_codes)
+            if logger.isEnabledFor(logging.DEBUG):
+                for hidden, code in self.hidden_and_codes:
+                    logger.debug(' - %s => %s', hidden, code)
+            logger.info('(%d possible hiddens left)', len(self.hidden_and_codes))
+
+    def replay(self, history: Iterable[Tuple[Tuple[int, ...], int, bool]]):
+        '''
+        applies recorded answers, e.g. of a game log, at once: the remaining hiddens are intersected with the hiddens
+        that give each answer as bitsets, and then filtered once
+        '''
+        history = list(history)
+        with self.instrumentation.stage('replay', questions=len(history)) as record:
+            hidden_set = self.hidden_set(self.hidden_and_codes)
+            for code, v, r in history:
+                if code not in self.space.code_indices or not 0 <= v < len(self.game.validators):
+                    raise ValueError(f'Invalid question: {code} {v}')
+                answer_set = self.pattern_hidden_mask(v, self.game.validators[v].pattern(self.space.code_indices[code]))
+                hidden_set &= answer_set if r else ~answer_set
+            n = len(self.hidden_and_codes)
+            self.hidden_and_codes = [self.indexed_hidden_and_codes[k] for k in iter_bits(hidden_set)]
+            self.history.extend(history)
+            self.instrumentation.count('hiddens pruned by answers', n - len(self.hidden_and_codes))
+            record['hiddens'] = len(self.hidden_and_codes)
+        logger.info('Replayed %d answers (%d possible hiddens left)', len(history), len(self.hidden_and_codes))
+
+    def check_should_query(self, code: Tuple[int, ...], v: int):
+        rs = self.game.validators[v].pattern(self.space.code_indices[code])
         results = { True: 0, False: 0 }
         for hidden, _ in self.hidden_and_codes:
             results[rs[hidden[v]]] += 1
         return results[True] != 0 and results[False] != 0
 
     @staticmethod
-    def try_validate(validators: Container[Validator], hidden: Container[int], code: Tuple[int, int, int]) -> bool:
+    def try_validate(validators: Container[Validator], hidden: Container[int], code: Tuple[int, ...]) -> bool:
         assert(len(hidden) == len(validators))
-        return all([validator.criterions[i](*code) for validator, i in zip(validators, hidden)])
+        return bool(Solver.hidden_mask(validators, hidden) >> validators[0].space.code_indices[code] & 1)
+
+    @staticmethod
+    def hidden_mask(validators: Container[Validator], hidden: Container[int]) -> int:
+        '''
+        returns mask of codes that satisfy all criterions of hidden
+        '''
+        mask = validators[0].space.all_codes_mask
+        for validator, i in zip(validators, hidden):
+            mask &= validator.masks[i]
+        return mask
     
     @staticmethod 
-    def check_hidden_possible(hidden: Container[int], validators: Container[Validator], filter_unique_answer) -> Optional[Tuple[int, int, int]]:
+    def check_hidden_possible(hidden: Container[int], validators: Container[Validator], filter_unique_answer) -> Optional[Tuple[int, ...]]:
         assert(len(hidden) == len(validators))
-        codes = []
-        for code in itertools.product(NUMBERS, NUMBERS, NUMBERS):
-            if Solver.try_validate(validators, hidden, code):
-                codes.append(code)
-        if filter_unique_answer and len(codes) > 1:
+        mask = Solver.hidden_mask(validators, hidden)
+        if filter_unique_answer and popcount(mask) > 1:
             return None
-        elif len(codes) > 0:
-            return codes[0]
+        elif mask:
+            return validators[0].space.codes[lowest_bit(mask)]
         else:
             return None
 
-    def has_useless_validators(self, hidden: Sequence[int], code: Tuple[int, int, int]) -> bool:
+    @staticmethod
+    def find_hidden_and_codes(validators: Sequence[Validator], filter_unique_answer: bool, filter_useless_validators: bool, instrumentation: Optional[Instrumentation] = None) -> Tuple[List[Tuple[Tuple[int, ...], Tuple[int, ...]]], Optional[List[int]]]:
+        '''
+        returns possible hiddens and their codes, in the same order as itertools.product,
+        and for each of them the first useless validator (-1 if none), or None if not filter_useless_validators
+        '''
+        space = validators[0].space
+        hidden_and_codes = []
+        useless = [] if filter_useless_validators else None
+        hidden = []
+        # prefixes[v] is the code set of hidden[:v]
+        prefixes = [space.all_codes_mask]
+        evaluations = 0
+        pruned_branches = 0
+        pruned_not_unique = 0
+
+        # depth-first search over criterions, pruning prefixes that leave no code
+        def search(v: int):
+            nonlocal evaluations, pruned_branches, pruned_not_unique
+            if v == len(validators):
+                mask = prefixes[-1]
+                if filter_unique_answer and popcount(mask) > 1:
+                    pruned_not_unique += 1
+                    return
+                hidden_and_codes.append((tuple(hidden), space.codes[lowest_bit(mask)]))
+                if useless is not None:
+                    useless.append(Solver.find_useless_validator(validators, hidden, filter_unique_answer, prefixes))
+                return
+            evaluations += len(validators[v].masks)
+            for i, criterion_mask in enumerate(validators[v].masks):
+                mask = prefixes[-1] & criterion_mask
+                if not mask:
+                    pruned_branches += 1
+                    continue
+                hidden.append(i)
+                prefixes.append(mask)
+                search(v + 1)
+                prefixes.pop()
+                hidden.pop()
+
+        search(0)
+        if instrumentation is not None:
+            instrumentation.count('criterion evaluations', evaluations + (2 * len(validators) * len(hidden_and_codes) if useless is not None else 0))
+            instrumentation.count('empty branches pruned', pruned_branches)
+            instrumentation.count('hiddens pruned by unique filter', pruned_not_unique)
+        return hidden_and_codes, useless
+
+    @staticmethod
+    def find_useless_validator(validators: Sequence[Validator], hidden: Sequence[int], filter_unique_answer: bool, prefixes: Optional[Sequence[int]] = None) -> int:
+        '''
+        returns the first validator that is useless for hidden, or -1 if none
+        prefixes[v] may be given as the code set of hidden[:v]
+        '''
         if len(hidden) == 1:
-            return False
+            return -1
+        all_codes_mask = validators[0].space.all_codes_mask
+        if prefixes is None:
+            prefixes = [all_codes_mask]
+            for validator, i in zip(validators, hidden):
+                prefixes.append(prefixes[-1] & validator.masks[i])
+        # suffixes[v] is the code set of hidden[v:]
+        suffixes = [all_codes_mask]
+        for v in reversed(range(len(hidden))):
+            suffixes.append(suffixes[-1] & validators[v].masks[hidden[v]])
+        suffixes.reverse()
         for v in range(len(hidden)):
-            other_hiddens = [hidden[x] for x in range(len(hidden)) if x != v]
-            other_validators = [self.game.validators[x] for x in range(len(hidden)) if x != v]
-            if Solver.check_hidden_possible(other_hiddens, other_validators, self.filter_unique_answer) is not None:
-                print(' -', hidden, '=>', code, '[x] validator', chr(v + ord('A')), 'is useless')
-                return True
+            # code set of all validators except v
+            mask = prefixes[v] & suffixes[v + 1]
+            if filter_unique_answer and popcount(mask) == 1 or not filter_unique_answer and mask:
+                return v
+        return -1
+
+    def has_useless_validators(self, hidden: Sequence[int], code: Tuple[int, ...]) -> bool:
+        v = Solver.find_useless_validator(self.game.validators, hidden, self.filter_unique_answer)
+        if v >= 0:
+            logger.debug(' - %s => %s [x] validator %s is useless', hidden, code, chr(v + ord('A')))
+            return True
         return False
 
-    def recursively_find_queries(self, previous_query: List[Tuple[Sequence[bool], int]], previous_hidden_and_codes: List[Tuple[Sequence[int], Tuple[int, int, int]]], previous_entropy: float, probability: float) -> List[Tuple[List[Tuple[Sequence[bool], int]], float]]:
-        if len(previous_query) == QUESTIONS_PER_ROUND:
+    def init_hidden_sets(self):
+        '''
+        index the filtered hiddens, so that any set of remaining hiddens is a bitset over these indices
+        '''
+        self.indexed_hidden_and_codes = list(self.hidden_and_codes)
+        self.hidden_indices = {hidden: k for k, (hidden, _) in enumerate(self.hidden_and_codes)}
+        # hidden_masks[v][i] is the set of hiddens whose validator v checks criterion i
+        self.hidden_masks = [[0] * len(validator.criterions) for validator in self.game.validators]
+        for hidden, k in self.hidden_indices.items():
+            for v, i in enumerate(hidden):
+                self.hidden_masks[v][i] |= 1 << k
+        self.pattern_hidden_masks = {}
+        self.code_mask_patterns = {}
+        self.code_pattern_lists = {}
+        self.query_cache = {}
+        self.question_bounds_cache = {}
+        self.hidden_and_codes_digest = None
+        self.weight_classes = self.prior_weight_classes()
+
+    def prior_weight_classes(self) -> Optional[List[Tuple[float, int]]]:
+        '''
+        returns the prior weight of the indexed hiddens as (weight, set of hiddens) of each weight, or None if uniform;
+        weights are relative, since they are only compared within a set of remaining hiddens
+        '''
+        if self.prior == 'hiddens':
+            return None
+        if self.prior == 'codes':
+            counts = collections.Counter([code for _, code in self.indexed_hidden_and_codes])
+            weights = [1 / counts[code] for _, code in self.indexed_hidden_and_codes]
+        else:
+            order = sorted(range(len(self.validator_ids)), key=lambda v: self.validator_ids[v])
+            counts = self.prior.get(tuple([self.validator_ids[v] for v in order]), {})
+            published = [counts.get(tuple([hidden[v] for v in order]), 0) for hidden, _ in self.indexed_hidden_and_codes]
+            total = sum(published)
+            if total == 0:
+                logger.info('No published puzzles of this game, prior is uniform over hiddens')
+                return None
+            n = len(published)
+            weights = [(1 - PRIOR_SMOOTHING) * count / total + PRIOR_SMOOTHING / n for count in published]
+        classes = {}
+        for k, weight in enumerate(weights):
+            classes[weight] = classes.get(weight, 0) | 1 << k
+        return sorted(classes.items())
+
+    def hidden_weight(self, hidden_set: int) -> float:
+        '''
+        returns prior weight of hidden_set, its number of hiddens if the prior is uniform
+        '''
+        if self.weight_classes is None:
+            return popcount(hidden_set)
+        return sum([weight * popcount(hidden_set & mask) for weight, mask in self.weight_classes])
+
+    def hidden_entropy(self, hidden_set: int) -> float:
+        '''
+        returns entropy of the true hidden within hidden_set, under the prior
+        '''
+        if self.weight_classes is None:
+            return math.log2(popcount(hidden_set))
+        counts = [(weight, popcount(hidden_set & mask)) for weight, mask in self.weight_classes]
+        total = sum([weight * n for weight, n in counts])
+        return math.log2(total) - sum([n * weight * math.log2(weight) for weight, n in counts if n]) / total
+
+    def hidden_set(self, hidden_and_codes: Iterable[Tuple[Sequence[int], Tuple[int, ...]]]) -> int:
+        hidden_set = 0
+        for hidden, _ in hidden_and_codes:
+            hidden_set |= 1 << self.hidden_indices[hidden]
+        return hidden_set
+
+    def pattern_hidden_mask(self, v: int, rs: Sequence[bool]) -> int:
+        '''
+        returns set of hiddens for which validator v answers True when its criterions give rs
+        '''
+        key = (v, rs)
+        mask = self.pattern_hidden_masks.get(key)
+        if mask is None:
+            mask = 0
+            for i, r in enumerate(rs):
+                if r:
+                    mask |= self.hidden_masks[v][i]
+            self.pattern_hidden_masks[key] = mask
+        return mask
+
+    def patterns_for_codes(self, v: int, code_mask: int) -> List[Sequence[bool]]:
+        '''
+        returns patterns of validator v that some code in code_mask produces, in order of their first code
+        '''
+        key = (v, code_mask)
+        patterns = self.code_mask_patterns.get(key)
+        if patterns is None:
+            codes = []
+            for rs, pattern_mask in self.game.validators[v].pattern_masks.items():
+                mask = pattern_mask & code_mask
+                if mask:
+                    codes.append((lowest_bit(mask), rs))
+            codes.sort()
+            patterns = [rs for _, rs in codes]
+            self.code_mask_patterns[key] = patterns
+        return patterns
+
+    def top_queries(self, hidden_set: int, k: int) -> List[Tuple[List[Tuple[Sequence[bool], int]], float]]:
+        '''
+        returns the k queries of a round with greatest entropy (or information, with exact scoring), best first, ties in search order
+        '''
+        if self.engine == 'codes' and self.workers > 1:
+            return self.top_code_queries_parallel(hidden_set, k)
+        # min-heap of (entropy, -sequence number, query), whose top is the k-th best query so far
+        heap = []
+        def threshold() -> float:
+            return heap[0][0] if len(heap) == k else -math.inf
+        if self.engine == 'codes':
+            queries = self.iter_code_queries(hidden_set, 0, range(len(self.space.codes)), threshold)
+        elif self.scoring == 'exact':
+            queries = self.iter_exact_queries(hidden_set, 0, self.space.all_codes_mask, threshold)
+        else:
+            queries = self.iter_queries(hidden_set, threshold)
+        for sequence, (query, entropy) in enumerate(queries):
+            item = (entropy, -sequence, query)
+            if len(heap) < k:
+                heapq.heappush(heap, item)
+            elif item > heap[0]:
+                heapq.heapreplace(heap, item)
+        return [(query, entropy) for entropy, _, query in sorted(heap, reverse=True)]
+
+    def iter_queries(self, hidden_set: int, threshold: Callable[[], float] = lambda: -math.inf) -> Iterator[Tuple[List[Tuple[Sequence[bool], int]], float]]:
+        '''
+        yields queries of a round that have more entropy than threshold(), and their entropies, in search order;
+        the queries after a first question are not searched if a bound of their entropy is not above threshold()
+        '''
+        if self.workers > 1:
+            for query, terms in self.find_query_suffixes(hidden_set, 0, self.space.all_codes_mask):
+                entropy = terms[0]
+                for term in terms[1:]:
+                    entropy += term
+                if entropy > threshold():
+                    yield query, entropy
+            return
+
+        for v in range(len(self.game.validators)):
+            for rs in self.patterns_for_codes(v, self.space.all_codes_mask):
+                question = (rs, v)
+                split = self.split_question(hidden_set, question)
+                if split is None:
+                    continue
+                entropy, p, hidden_set_if_true = split
+                if entropy > threshold():
+                    yield [question], entropy
+
+                mask = self.game.validators[v].pattern_masks[rs]
+                children = ((hidden_set_if_true, p), (hidden_set ^ hidden_set_if_true, 1 - p))
+                bound = 0.0
+                for child_set, child_p in children:
+                    for question_entropy, after in self.question_bounds(child_set, 1 << v, mask):
+                        bound = max(bound, child_p * question_entropy + after)
+                if entropy + bound + ENTROPY_EPSILON <= threshold():
+                    self.instrumentation.count('query subtrees pruned')
+                    continue
+
+                for child_set, child_p in children:
+                    for suffix, terms in self.find_query_suffixes(child_set, 1 << v, mask):
+                        query_entropy = entropy + child_p * terms[0]
+                        for term in terms[1:]:
+                            query_entropy += term
+                        if query_entropy > threshold():
+                            yield [question] + suffix, query_entropy
+
+    def iter_exact_queries(self, hidden_set: int, queried: int, code_mask: int, threshold: Callable[[], float] = lambda: -math.inf) -> Iterator[Tuple[List[Tuple[Sequence[bool], int]], float]]:
+        '''
+        yields queries of the rest of a round, after the validators in queried, for codes in code_mask, that have more
+        information than threshold(), and their information, in search order: the entropy of the histogram of the joint
+        answers of the whole query over hidden_set, weighted by prior
+        the histogram is kept as the sets of hiddens giving each combination of answers, and questions are added in
+        validator order, only if they split some of these sets; a query is not extended if each further question
+        giving a bit cannot beat threshold()
+        '''
+        max_questions = min(QUESTIONS_PER_ROUND, len(self.game.validators)) - popcount(queried)
+
+        def search(start: int, code_mask: int, cells: List[int], query: List[Tuple[Sequence[bool], int]]) -> Iterator[Tuple[List[Tuple[Sequence[bool], int]], float]]:
+            for v in range(start, len(self.game.validators)):
+                if queried >> v & 1:
+                    continue
+                for rs in self.patterns_for_codes(v, code_mask):
+                    hidden_mask = self.pattern_hidden_mask(v, rs)
+                    split_cells = []
+                    for cell in cells:
+                        cell_if_true = cell & hidden_mask
+                        if cell_if_true:
+                            split_cells.append(cell_if_true)
+                        if cell_if_true != cell:
+                            split_cells.append(cell ^ cell_if_true)
+                    if len(split_cells) == len(cells):
+                        continue
+                    self.instrumentation.count('query nodes expanded')
+                    information = self.information(split_cells)
+                    extended = query + [(rs, v)]
+                    if information > threshold():
+                        yield extended, information
+                    if len(extended) == max_questions:
+                        continue
+                    if information + max_questions - len(extended) + ENTROPY_EPSILON <= threshold():
+                        self.instrumentation.count('query subtrees pruned')
+                        continue
+                    yield from search(v + 1, code_mask & self.game.validators[v].pattern_masks[rs], split_cells, extended)
+
+        if max_questions > 0 and popcount(hidden_set) > 1:
+            yield from search(0, code_mask, [hidden_set], [])
+
+    def iter_code_queries(self, hidden_set: int, queried: int, codes: Iterable[int], threshold: Callable[[], float] = lambda: -math.inf) -> Iterator[Tuple[List[Tuple[Sequence[bool], int]], float]]:
+        '''
+        yields queries of the rest of a round, after the validators in queried, with a proposal code among codes (indices),
+        that have more information than threshold(), and their information, in order of codes and then of number of questions
+        for each code, the answers of the remaining hiddens to each validator are a column of the (hiddens x validators)
+        answer matrix, kept as a bitset over hiddens; the answer histograms of all subsets of validators are split from
+        these columns level by level, and a validator is only added if it splits the histogram
+        queries whose questions split the hiddens the same way are equivalent, so each is yielded for the first code only,
+        which is the code find_code_for_query returns
+        '''
+        validators = [v for v in range(len(self.game.validators)) if not queried >> v & 1]
+        max_questions = min(QUESTIONS_PER_ROUND, len(self.game.validators)) - popcount(queried)
+        if max_questions <= 0 or popcount(hidden_set) <= 1:
+            return
+        code_patterns = [self.code_patterns(v) for v in validators]
+        seen_codes = set()
+        # (position in validators, column) of each question of a query => (cells of its answer histogram, information),
+        # or None if its last question does not split them; queries recur for many codes, so each is split once
+        splits = {}
+        for k in codes:
+            patterns = [code_patterns[j][k] for j in range(len(validators))]
+            columns = tuple([hidden_set & self.pattern_hidden_mask(v, rs) for v, rs in zip(validators, patterns)])
+            if columns in seen_codes:
+                continue
+            seen_codes.add(columns)
+            self.instrumentation.count('proposal codes searched')
+            # (key in splits, cells of the answer histogram) of the queries of the previous level
+            level = [((), [hidden_set])]
+            for n_questions in range(1, max_questions + 1):
+                next_level = []
+                for key, cells in level:
+                    for j in range(key[-2] + 1 if key else 0, len(validators)):
+                        extended = key + (j, columns[j])
+                        split = splits.get(extended, False)
+                        if split is None:
+                            continue
+                        if split is False:
+                            column = columns[j]
+                            split_cells = []
+                            for cell in cells:
+                                cell_if_true = cell & column
+                                if cell_if_true:
+                                    split_cells.append(cell_if_true)
+                                if cell_if_true != cell:
+                                    split_cells.append(cell ^ cell_if_true)
+                            if len(split_cells) == len(cells):
+                                splits[extended] = None
+                                continue
+                            information = self.information(split_cells)
+                            splits[extended] = (split_cells, information)
+                            if information > threshold():
+                                yield [(patterns[i], validators[i]) for i in extended[::2]], information
+                        else:
+                            split_cells, information = split
+                        if n_questions == max_questions:
+                            continue
+                        if information + max_questions - n_questions + ENTROPY_EPSILON <= threshold():
+                            self.instrumentation.count('query subtrees pruned')
+                            continue
+                        next_level.append((extended, split_cells))
+                level = next_level
+
+    def code_patterns(self, v: int) -> List[Tuple[bool, ...]]:
+        '''
+        returns the pattern of validator v for each code
+        '''
+        patterns = self.code_pattern_lists.get(v)
+        if patterns is None:
+            patterns = [None] * len(self.space.codes)
+            for rs, mask in self.game.validators[v].pattern_masks.items():
+                for k in iter_bits(mask):
+                    patterns[k] = rs
+            self.code_pattern_lists[v] = patterns
+        return patterns
+
+    def top_code_queries(self, hidden_set: int, codes: Iterable[int], k: int) -> List[Tuple[float, int, List[Tuple[Sequence[bool], int]]]]:
+        '''
+        returns (information, -sequence number, query) of the k queries with a proposal code among codes with greatest information
+        '''
+        heap = []
+        def threshold() -> float:
+            return heap[0][0] if len(heap) == k else -math.inf
+        for sequence, (query, information) in enumerate(self.iter_code_queries(hidden_set, 0, codes, threshold)):
+            item = (information, -sequence, query)
+            if len(heap) < k:
+                heapq.heappush(heap, item)
+            elif item > heap[0]:
+                heapq.heapreplace(heap, item)
+        return heap
+
+    def top_code_queries_parallel(self, hidden_set: int, k: int) -> List[Tuple[List[Tuple[Sequence[bool], int]], float]]:
+        '''
+        returns the same queries as top_queries with the codes engine, searching ranges of proposal codes in worker processes;
+        queries that split the hiddens the same way, found for several ranges, are kept for the first one, as the serial
+        search keeps them for the first code
+        '''
+        n_codes = len(self.space.codes)
+        n_chunks = min(n_codes, 4 * self.workers)
+        chunks = [range(n_codes * c // n_chunks, n_codes * (c + 1) // n_chunks) for c in range(n_chunks)]
+        best = {}
+        for c, top in enumerate(self.get_executor().map(_top_code_queries, [(hidden_set, chunk, k) for chunk in chunks])):
+            for information, negative_sequence, query in top:
+                # the hiddens of each question that answer True, as split in iter_code_queries
+                key = tuple([(v, hidden_set & self.pattern_hidden_mask(v, rs)) for rs, v in query])
+                if key not in best:
+                    best[key] = (information, -c, negative_sequence, query)
+        top = sorted(best.values(), key=lambda item: item[:3], reverse=True)[:k]
+        return [(query, information) for information, _, _, query in top]
+
+    def information(self, cells: Sequence[int]) -> float:
+        '''
+        returns entropy of which of the disjoint non-empty hidden sets cells the true hidden is in, under the prior
+        '''
+        weights = [self.hidden_weight(cell) for cell in cells]
+        total = sum(weights)
+        return math.log2(total) - sum([weight * math.log2(weight) for weight in weights]) / total
+
+    def question_bounds(self, hidden_set: int, queried: int, previous_mask: int) -> List[Tuple[float, float]]:
+        '''
+        returns, for each question that can follow a state, its entropy and a bound of the entropy terms of the questions after it:
+        each one is at most a bit, and the first one is weighted by the probability of the answer it follows
+        '''
+        key = (hidden_set, queried, previous_mask)
+        bounds = self.question_bounds_cache.get(key)
+        if bounds is not None:
+            return bounds
+        bounds = []
+        more_questions = min(QUESTIONS_PER_ROUND, len(self.game.validators)) - popcount(queried) - 1
+        if more_questions >= 0:
+            for v in range(len(self.game.validators)):
+                if queried >> v & 1:
+                    continue
+                for rs in self.patterns_for_codes(v, previous_mask):
+                    split = self.split_question(hidden_set, (rs, v))
+                    if split is None:
+                        continue
+                    entropy, p, hidden_set_if_true = split
+                    after = 0.0
+                    if more_questions > 0:
+                        n_true = popcount(hidden_set_if_true)
+                        n_false = popcount(hidden_set) - n_true
+                        after = max(p if n_true >= 2 else 0.0, 1 - p if n_false >= 2 else 0.0)
+                        if after > 0.0:
+                            after += more_questions - 1
+                    bounds.append((entropy, after))
+        self.question_bounds_cache[key] = bounds
+        return bounds
+
+    def find_query_suffixes(self, hidden_set: int, queried: int, previous_mask: int) -> List[Tuple[List[Tuple[Sequence[bool], int]], Tuple[float, ...]]]:
+        '''
+        returns all queries that can follow a state, each with its entropy terms:
+        the first term is weighted by the probability of reaching the state, the others are added as is
+        a state is (remaining hiddens, queried validators, codes that satisfy all previous queries),
+        which does not depend on the order of previous questions, so each state is expanded once
+        '''
+        if popcount(queried) == QUESTIONS_PER_ROUND:
             return []
+        key = (hidden_set, queried, previous_mask)
+        cached = self.query_cache.get(key)
+        if cached is not None:
+            self.instrumentation.count('query cache hits')
+            return cached
+        self.instrumentation.count('query nodes expanded')
 
-        result_queries_and_entropies: List[Tuple[List[Tuple[List[bool], int]], float]] = []
         # choose from each validator
+        questions = []
         for v in range(len(self.game.validators)):
             # if this validator has been queried before, skip
-            if any([question[1] == v for question in previous_query]):
+            if queried >> v & 1:
                 continue
-            codes = {}
-            for code in itertools.product(NUMBERS, NUMBERS, NUMBERS):
-                # check this satisfies all previous queries
-                if not all([tuple([criterion(*code) for criterion in self.game.validators[question_v].criterions]) == question_rs for question_rs, question_v in previous_query]):
-                    continue
-                rs = tuple([criterion(*code) for criterion in self.game.validators[v].criterions])
-                codes.setdefault(rs, code)
-
-            for rs, code in codes.items():
-                results = { True: 0, False: 0 }
-                for hidden, _ in previous_hidden_and_codes:
-                    results[rs[hidden[v]]] += 1
-                if results[True] == 0 or results[False] == 0:
-                    continue
-                p = results[True] / (results[True] + results[False])
-                entropy = -p * math.log2(p) - (1 - p) * math.log2(1 - p) if p > 0.0 and p < 1.0 else 0.0
-                entropy = previous_entropy + probability * entropy
-
-                # append to result
-                query = previous_query + [(rs, v)]
-                result_queries_and_entropies.append((query, entropy))
-
-                # recursively find more queries
-                hidden_and_codes_if_true = [(h, op) for h, op in previous_hidden_and_codes if self.game.validators[v].criterions[h[v]](*code) == True]
-                result_queries_and_entropies.extend(self.recursively_find_queries(query, hidden_and_codes_if_true, entropy, p))
-                hidden_and_codes_if_false = [(h, op) for h, op in previous_hidden_and_codes if self.game.validators[v].criterions[h[v]](*code) == False]
-                result_queries_and_entropies.extend(self.recursively_find_queries(query, hidden_and_codes_if_false, entropy, 1 - p))
-        return result_queries_and_entropies
-
-    def find_code_for_query(self, query: Iterable[Tuple[Sequence[bool], int]]) -> Optional[Tuple[int, int, int]]:
-        def check_code_for_question(code: Tuple[int, int, int], question: Tuple[Tuple[int, int, int], int]) -> bool:
-            question_rs, question_v = question
-            return tuple([criterion(*code) for criterion in self.game.validators[question_v].criterions]) == question_rs
-        for code in itertools.product(NUMBERS, NUMBERS, NUMBERS):
-            if all([check_code_for_question(code, question) for question in query]):
-                return code
-        return None
+            for rs in self.patterns_for_codes(v, previous_mask):
+                questions.append((rs, v))
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser()
-    parser.add_argument('validator_ids', nargs='+', type=int)
-    parser.add_argument('--no-filter-unique', action='store_true')
-    parser.add_argument('--no-filter-useless', action='store_true')
-    args = parser.parse_args()
+        result = []
+        if queried == 0 and self.workers > 1:
+            # first questions of a round are independent subtrees
+            for subtree in self.get_executor().map(_find_question_suffixes, [(hidden_set, question) for question in questions]):
+                result.extend(subtree)
+        else:
+            for question in questions:
+                result.extend(self.find_question_suffixes(hidden_set, queried, previous_mask, question))
+        self.query_cache[key] = result
+        return result
 
-    kwargs = {}
-    if args.no_filter_unique:
-        kwargs['filter_unique_answer'] = False
-    if args.no_filter_useless:
-        kwargs['filter_useless_validators'] = False
-    
-    solver = Solver(args.validator_ids, **kwargs)
+    def find_question_suffixes(self, hidden_set: int, queried: int, previous_mask: int, question: Tuple[Sequence[bool], int]) -> List[Tuple[List[Tuple[Sequence[bool], int]], Tuple[float, ...]]]:
+        '''
+        returns all queries that can follow a state and start with question, each with its entropy terms
+        '''
+        split = self.split_question(hidden_set, question)
+        if split is None:
+            return []
+        entropy, p, hidden_set_if_true = split
+        rs, v = question
+
+        # append to result
+        result = [([question], (entropy,))]
+
+        # recursively find more queries
+        mask = previous_mask & self.game.validators[v].pattern_masks[rs]
+        for child_set, child_p in ((hidden_set_if_true, p), (hidden_set ^ hidden_set_if_true, 1 - p)):
+            for suffix, terms in self.find_query_suffixes(child_set, queried | 1 << v, mask):
+                result.append(([question] + suffix, (entropy, child_p * terms[0]) + terms[1:]))
+        return result
+
+    def split_question(self, hidden_set: int, question: Tuple[Sequence[bool], int]) -> Optional[Tuple[float, float, int]]:
+        '''
+        returns entropy of question, probability of True and hiddens for which it is True, or None if it does not split hidden_set
+        '''
+        rs, v = question
+        n = popcount(hidden_set)
+        hidden_set_if_true = hidden_set & self.pattern_hidden_mask(v, rs)
+        n_true = popcount(hidden_set_if_true)
+        if n_true == 0 or n_true == n:
+            return None
+        p = n_true / n
+        entropy = -p * math.log2(p) - (1 - p) * math.log2(1 - p) if p > 0.0 and p < 1.0 else 0.0
+        return entropy, p, hidden_set_if_true
+
+    def get_executor(self) -> 'ProcessPoolExecutor':
+        '''
+        returns process pool for query search; each worker holds a copy of this solver,
+        rebuilt from validator ids and indexed hiddens since criterions cannot be pickled
+        '''
+        if self.executor is None:
+            from concurrent.futures import ProcessPoolExecutor
+            cards = {card: CUSTOM_CARDS[card] for card in self.validator_ids if card in CUSTOM_CARDS}
+            options = dict(scoring=self.scoring, prior=self.prior, engine=self.engine)
+            self.executor = ProcessPoolExecutor(self.workers, initializer=_init_query_worker, initargs=(self.validator_ids, self.mode, (self.space.digits, self.space.values), self.indexed_hidden_and_codes, cards, options))
+        return self.executor
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def query_mask(self, query: Iterable[Tuple[Sequence[bool], int]]) -> int:
+        '''
+        returns mask of codes that produce the response patterns of all questions in query
+        '''
+        mask = self.space.all_codes_mask
+        for question_rs, question_v in query:
+            mask &= self.game.validators[question_v].pattern_masks.get(tuple(question_rs), 0)
+        return mask
+
+    def find_code_for_query(self, query: Iterable[Tuple[Sequence[bool], int]]) -> Optional[Tuple[int, ...]]:
+        mask = self.query_mask(query)
+        if mask:
+            return self.space.codes[lowest_bit(mask)]
+        return None
+
+def play(solver: Solver, answer: Callable[[Tuple[int, ...], int], bool], on_answer: Optional[Callable[[], None]] = None) -> int:
+    '''
+    plays until solved, asking answer(code, v) for each useful question and calling on_answer() after each answer is applied;
+    returns number of rounds played
+    '''
+    rounds = 0
     if solver.solved():
         solver.print_solved()
     while not solver.solved():
         query = solver.next_query()
         if not query:
             break
-        for question in query:
-            code, v = question
+        rounds += 1
+        asked = []
+        while query:
+            code, v = query.pop(0)
             if not solver.check_should_query(code, v):
-                print('Skip question: ', chr(v + ord("A")), code)
+                logger.info('Skip question:  %s %s', chr(v + ord('A')), code)
                 continue
 
-            r = None
-            while r not in ['0', '1']:
-                r = input(f'> {code} {chr(v + ord("A"))}: ')
-            r = bool(int(r))
+            r = answer(code, v)
             solver.update_question_result(code, v, r)
+            if on_answer is not None:
+                on_answer()
+            asked.append(v)
             if solver.solved():
                 solver.print_solved()
                 break
+            if solver.replan:
+                query = solver.replan_query(code, asked)
+    return rounds
+
+def map_in_batches(executor: 'Executor', fn: Callable, iterable: Iterable, batch_size: int, chunksize: int = 1) -> Iterator:
+    '''
+    yields fn of each item of iterable in order, like executor.map, but submits batch_size items at a time,
+    so that pending items and results are bounded even for long or endless iterables
+    '''
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, batch_size))
+        if not batch:
+            return
+        yield from executor.map(fn, batch, chunksize=chunksize)
+
+_worker_solver: Optional[Solver] = None
+
+def _init_query_worker(validator_ids: List[int], mode: str, space: Tuple[int, int], hidden_and_codes: List[Tuple[Tuple[int, ...], Tuple[int, ...]]], cards: Dict[int, List[str]], options: dict):
+    global _worker_solver
+    logger.setLevel(logging.WARNING)
+    space = code_space(*space)
+    from criterion_dsl import add_card
+    for card, criterions in cards.items():
+        add_card(card, criterions, space)
+    _worker_solver = Solver(validator_ids, mode=mode, space=space, hidden_and_codes=hidden_and_codes, **options)
+
+def _find_question_suffixes(task: Tuple[int, Tuple[Sequence[bool], int]]) -> List[Tuple[List[Tuple[Sequence[bool], int]], Tuple[float, ...]]]:
+    hidden_set, question = task
+    return _worker_solver.find_question_suffixes(hidden_set, 0, _worker_solver.space.all_codes_mask, question)
+
+def _top_code_queries(task: Tuple[int, range, int]) -> List[Tuple[float, int, List[Tuple[Sequence[bool], int]]]]:
+    hidden_set, codes, k = task
+    return _worker_solver.top_code_queries(hidden_set, codes, k)
+
+def add_solver_arguments(parser: argparse.ArgumentParser):
+    '''
+    adds options of Solver, and of logging and instrumentation
+    '''
+    parser.add_argument('--cards', help='JSON file of custom validator cards, see criterion_dsl.py')
+    parser.add_argument('--digits', type=int, default=3, help='number of digits of a code, for variants')
+    parser.add_argument('--values', type=int, default=len(NUMBERS), help='digits are from 1 to this, for variants')
+    parser.add_argument('--mode', choices=MODES, default='classic', help='extreme: give two cards per validator; nightmare: cards are assigned to validators in an unknown order')
+    parser.add_argument('--no-filter-unique', action='store_true')
+    parser.add_argument('--no-filter-useless', action='store_true')
+    parser.add_argument('--backend', choices=BACKENDS, default='python', help='engine for enumerating possible hiddens')
+    parser.add_argument('--lookahead', type=int, default=0, help='plan this many rounds ahead instead of picking the query with greatest entropy')
+    parser.add_argument('--lookahead-width', type=int, default=8, help='number of queries with greatest entropy considered at each planning step')
+    parser.add_argument('--worst-case', action='store_true', help='plan for worst-case instead of expected rounds and questions')
+    parser.add_argument('--no-replan', action='store_true', help='keep the questions of a round instead of picking the rest again after each answer')
+    parser.add_argument('--scoring', choices=SCORINGS, default='entropy', help='exact: score a round by the information of all its answers together')
+    parser.add_argument('--engine', choices=ENGINES, default='patterns', help='codes: search proposal codes first, needs --scoring exact')
+    parser.add_argument('--prior', default='hiddens', help='with exact scoring, which hiddens are likely: hiddens, codes (each code equally likely), or a file of published puzzles')
+    parser.add_argument('--workers', type=int, default=1, help='number of processes for query search')
+    parser.add_argument('--book', help='solution book built by book.py, to skip initialization')
+    parser.add_argument('--cache', action='store_true', help='cache filtered hiddens and best queries in memory')
+    parser.add_argument('--cache-path', help='also store cached states in this SQLite file')
+    parser.add_argument('--cache-entries', type=int, default=100000, help='number of cached states kept in memory')
+    parser.add_argument('--cache-memory', type=int, default=64, help='MiB of cached states kept in memory')
+    add_instrumentation_arguments(parser)
+
+def solver_kwargs(args: argparse.Namespace) -> dict:
+    kwargs = {}
+    space = code_space(args.digits, args.values)
+    if space is not DEFAULT_SPACE:
+        kwargs['space'] = space
+    if args.cards:
+        from criterion_dsl import load_cards
+        load_cards(args.cards, space)
+    if args.mode != 'classic':
+        kwargs['mode'] = args.mode
+    if args.no_filter_unique:
+        kwargs['filter_unique_answer'] = False
+    if args.no_filter_useless:
+        kwargs['filter_useless_validators'] = False
+    if args.backend != 'python':
+        kwargs['backend'] = args.backend
+    if args.lookahead > 0:
+        kwargs['lookahead'] = args.lookahead
+        kwargs['lookahead_width'] = args.lookahead_width
+        kwargs['lookahead_worst_case'] = args.worst_case
+    if args.no_replan:
+        kwargs['replan'] = False
+    if args.scoring != 'entropy':
+        kwargs['scoring'] = args.scoring
+    if args.engine != 'patterns':
+        kwargs['engine'] = args.engine
+    if args.prior in PRIORS:
+        if args.prior != 'hiddens':
+            kwargs['prior'] = args.prior
+    else:
+        from puzzles import load_prior
+        kwargs['prior'] = load_prior(args.prior)
+    if args.workers > 1:
+        kwargs['workers'] = args.workers
+    if args.book:
+        from book import Book
+        kwargs['book'] = Book(args.book)
+    if args.cache or args.cache_path:
+        from state_cache import StateCache
+        kwargs['cache'] = StateCache(max_entries=args.cache_entries, max_bytes=args.cache_memory << 20, path=args.cache_path)
+    kwargs['instrumentation'] = instrumentation_from_args(args)
+    return kwargs
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('validator_ids', nargs='*', type=int)
+    parser.add_argument('--log', help='write the game to this file after each answer, see game_log.py')
+    parser.add_argument('--resume', help='continue the game logged in this file, with its answers applied')
+    add_solver_arguments(parser)
+    args = parser.parse_args()
+    if not args.validator_ids and not args.resume:
+        parser.error('validator_ids or --resume is required')
+    kwargs = solver_kwargs(args)
+
+    def ask(code: Tuple[int, ...], v: int) -> bool:
+        r = None
+        while r not in ['0', '1']:
+            r = input(f'> {code} {chr(v + ord("A"))}: ')
+        return bool(int(r))
+
+    if args.resume:
+        import game_log
+        record = game_log.read_log(args.resume)
+        if args.validator_ids and args.validator_ids != record['cards']:
+            parser.error(f'{args.resume} is a game of cards {record["cards"]}')
+        solver = game_log.resume(record, **kwargs)
+        log_path = args.log or args.resume
+    else:
+        solver = Solver(args.validator_ids, **kwargs)
+        log_path = args.log
+
+    def write_log():
+        import game_log
+        game_log.write_log(log_path, game_log.game_record(solver))
+
+    try:
+        play(solver, ask, write_log if log_path else None)
+    finally:
+        solver.close()
+        if solver.cache is not None:
+            logger.info('State cache: %s', ', '.join([f'{name} {value}' for name, value in solver.cache.stats().items()]))
+            solver.cache.close()
+        solver.instrumentation.close(args.profile)